@@ -2,15 +2,23 @@
 # 功能: 接收指定账号转发的消息，检测关键词并提醒用户，支持独立关键词配置、屏蔽功能
 
 import asyncio
+import bisect
 import logging
 import json
+import multiprocessing
 import os
 import re
-from datetime import datetime
-from typing import Dict, List, Optional
+import secrets
+import shutil
+import tempfile
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
 from telegram import Update, Message
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import sqlite3
 
@@ -26,6 +34,9 @@ BANNER = f"""
 ╚══════════════════════════════════════════════════════════╝
 """
 
+# 机器人实际处理的更新类型，其余类型不再由 Telegram 推送
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # 配置日志
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -46,25 +57,1168 @@ def escape_markdown_v2(text: str) -> str:
     return re. sub(f'([{re.escape(escape_chars)}])', r'\\\1', str(text))
 
 
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """格式化 Prometheus 标签"""
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricCounter:
+    """只增计数器，labels 为与 labelnames 对应的值元组"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels: Optional[tuple] = None) -> float:
+        """指定标签的值，未指定时返回所有标签之和"""
+        if labels is None:
+            return sum(self.values.values())
+        return self.values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.values or ({(): 0} if not self.labelnames else {})
+        for labels, value in list(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class MetricGauge(MetricCounter):
+    """瞬时值；提供 func 时在导出时调用，返回数值或 {标签元组: 数值}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, func=None, labelnames: tuple = (), kind: str = 'gauge'):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+        self.kind = kind
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        if self.func is not None:
+            result = self.func()
+            self.values = result if isinstance(result, dict) else {(): result}
+        return super().render()
+
+
+class MetricHistogram:
+    """固定分桶直方图，observe 只做一次二分查找和两次加法"""
+
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数 ..., +Inf 桶计数, 总和]
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels: Optional[tuple] = None) -> int:
+        if labels is None:
+            return sum(sum(series[:-1]) for series in list(self.series.values()))
+        series = self.series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q: float, labels: Optional[tuple] = None) -> Optional[float]:
+        """按分桶估算分位数 (桶内线性插值)，没有数据时返回 None"""
+        if labels is None:
+            all_series = list(self.series.values())
+        else:
+            all_series = [self.series[labels]] if labels in self.series else []
+        counts = [sum(column) for column in zip(*(series[:-1] for series in all_series))]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {series[-1]}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，以 Prometheus 文本格式导出到本地 HTTP 端口"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics: Dict[str, object] = {}
+        # 导出前执行的异步采集函数 (例如需要查询数据库的队列深度)
+        self.collectors: Dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> MetricCounter:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.metrics:
+            self.metrics[full_name] = MetricCounter(full_name, help_text, labelnames)
+        return self.metrics[full_name]
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = MetricHistogram.DEFAULT_BUCKETS) -> MetricHistogram:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.metrics:
+            self.metrics[full_name] = MetricHistogram(full_name, help_text, labelnames, buckets)
+        return self.metrics[full_name]
+
+    def gauge(self, name: str, help_text: str, func=None, labelnames: tuple = (),
+              kind: str = 'gauge') -> MetricGauge:
+        """注册或替换一个瞬时值指标"""
+        full_name = f"{self.prefix}_{name}"
+        self.metrics[full_name] = MetricGauge(full_name, help_text, func, labelnames, kind)
+        return self.metrics[full_name]
+
+    def add_collector(self, name: str, func):
+        self.collectors[name] = func
+
+    async def collect(self):
+        for name, func in list(self.collectors.items()):
+            try:
+                await func()
+            except Exception as e:
+                logger.error(f"采集指标 {name} 失败: {e}")
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"导出指标 {metric.name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.split()
+            path = parts[1].decode().split('?')[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                await self.collect()
+                body = self.render().encode('utf-8')
+                status = b'200 OK'
+            else:
+                body = b'not found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, listen: str, port: int) -> asyncio.AbstractServer:
+        """在 listen:port 上提供 /metrics"""
+        return await asyncio.start_server(self._handle, listen, port)
+
+
+# 运行指标 (Prometheus 文本格式)，取代原先的 stats 计数
+METRICS = MetricsRegistry('keyword_bot')
+MESSAGES_RECEIVED = METRICS.counter('messages_received_total', '收到的转发消息数')
+KEYWORDS_MATCHED = METRICS.counter('keywords_matched_total', '命中关键词的用户次数')
+ALERTS_SENT = METRICS.counter('alerts_sent_total', '发送成功的提醒数')
+ALERT_FAILURES = METRICS.counter('alert_failures_total', '发送失败的提醒数', ('error',))
+REGEX_TIMEOUTS = METRICS.counter('regex_timeouts_total', '正则匹配超出时间预算的次数')
+ALERT_SEND_SECONDS = METRICS.histogram('alert_send_seconds', '单条提醒的发送耗时', ('result',))
+ALERT_DELIVERY_SECONDS = METRICS.histogram(
+    'alert_delivery_seconds', '从收到消息到提醒送达的耗时',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120, 300))
+SQLITE_WRITE_SECONDS = METRICS.histogram('sqlite_write_seconds', 'SQLite 写事务耗时', ('table',))
+KEYWORD_MATCH_SECONDS = METRICS.histogram(
+    'keyword_match_seconds', '单条消息检查所有用户关键词的耗时',
+    buckets=(0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+
+
+class KeywordAutomaton:
+    """多关键词匹配自动机 (Aho-Corasick)，一次扫描文本找出所有出现的关键词"""
+
+    def __init__(self, keywords: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Optional[str]] = [None]
+        # 失配链上最近的、有关键词结尾的节点，用于列出在同一位置结尾的所有关键词
+        self.dict_link: List[int] = [0]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword: str):
+        if not keyword:
+            return
+        node = 0
+        for ch in keyword:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.dict_link.append(0)
+            node = nxt
+        self.output[node] = keyword
+
+    def _build(self):
+        """按广度优先构建失配指针与输出链"""
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                fallback = self.goto[state].get(ch, 0)
+                link = fallback if fallback != child else 0
+                self.fail[child] = link
+                self.dict_link[child] = link if self.output[link] is not None else self.dict_link[link]
+
+    def findall(self, text: str) -> List[str]:
+        """按首次出现的顺序返回文本中的所有关键词 (去重)"""
+        found: Dict[str, None] = {}
+        goto, fail, output, dict_link = self.goto, self.fail, self.output, self.dict_link
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            node = state if output[state] is not None else dict_link[state]
+            # 输出链上较短的关键词都是当前关键词的后缀，已记录过的关键词之后无需再走
+            while node and output[node] not in found:
+                found[output[node]] = None
+                node = dict_link[node]
+        return list(found)
+
+
+class RegexIndex:
+    """正则关键词索引: 每个正则只编译一次，可合并的正则按块组成带命名分组的多选表达式
+
+    每块先整体搜索一次，未命中即跳过整块；命中时由分组名确定命中的正则，块内其余正则再单独确认。
+    含反向引用、命名分组、条件分组或全局内联标志的正则合并后含义会变，单独执行；
+    曾经超时的正则也单独执行并排在最后。
+    """
+
+    CHUNK_SIZE = 50
+    _UNSAFE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(|\(\?[aiLmsux]+\)')
+
+    def __init__(self):
+        # (正则, flags) -> 编译结果，无效的正则记为 None
+        self.compiled: Dict[Tuple[str, int], Optional[re.Pattern]] = {}
+        # [(合并后的表达式, {分组名: 正则})]
+        self.programs: List[Tuple[re.Pattern, Dict[str, str]]] = []
+        self.standalone: List[str] = []
+        # 正则 -> 位置编号 (从 1 开始)，用于报告执行进度
+        self.ids: Dict[str, int] = {}
+        self.flags = 0
+
+    def compile(self, pattern: str, flags: int) -> Optional[re.Pattern]:
+        """编译并缓存单个正则"""
+        key = (pattern, flags)
+        if key not in self.compiled:
+            try:
+                self.compiled[key] = re.compile(pattern, flags)
+            except re.error:
+                self.compiled[key] = None
+        return self.compiled[key]
+
+    def build(self, patterns: List[str], flags: int, isolated=()):
+        """按当前的正则集合重建合并表达式，isolated 中的正则单独执行并排在最后"""
+        self.flags = flags
+        self.ids = {pattern: i + 1 for i, pattern in enumerate(patterns)}
+        self.compiled = {key: value for key, value in self.compiled.items()
+                         if key[1] == flags and key[0] in self.ids}
+        isolated = set(isolated)
+        combinable = []
+        late = []
+        self.standalone = []
+        for pattern in patterns:
+            compiled = self.compile(pattern, flags)
+            if compiled is None:
+                continue
+            if pattern in isolated:
+                late.append(pattern)
+            elif compiled.groupindex or self._UNSAFE.search(pattern):
+                self.standalone.append(pattern)
+            else:
+                combinable.append(pattern)
+
+        self.programs = []
+        for start in range(0, len(combinable), self.CHUNK_SIZE):
+            chunk = combinable[start:start + self.CHUNK_SIZE]
+            names = {f"k{i}": pattern for i, pattern in enumerate(chunk)}
+            source = "|".join(f"(?P<{name}>{pattern})" for name, pattern in names.items())
+            try:
+                self.programs.append((re.compile(source, flags), names))
+            except re.error:
+                self.standalone.extend(chunk)
+        self.standalone.extend(late)
+
+    def search(self, text: str, progress=None, skip=()) -> Tuple[List[str], List[tuple]]:
+        """返回 (能匹配的正则, 各步耗时 [(位置, 秒)])
+
+        progress 为进程间共享的整数，每一步执行前写入位置: -n 为第 n 个合并组，n 为编号 n 的正则。
+        """
+        matched = []
+        costs = []
+        for i, (program, names) in enumerate(self.programs):
+            if progress is not None:
+                progress.value = -(i + 1)
+            started = time.perf_counter()
+            m = program.search(text)
+            costs.append((-(i + 1), time.perf_counter() - started))
+            if m is None:
+                continue
+            hit = names.get(m.lastgroup)
+            if hit is not None and hit not in skip:
+                matched.append(hit)
+            for pattern in names.values():
+                if pattern != hit and pattern not in skip and self._run(pattern, text, progress, costs):
+                    matched.append(pattern)
+        for pattern in self.standalone:
+            if pattern not in skip and self._run(pattern, text, progress, costs):
+                matched.append(pattern)
+        return matched, costs
+
+    def _run(self, pattern: str, text: str, progress, costs: list) -> bool:
+        step = self.ids[pattern]
+        if progress is not None:
+            progress.value = step
+        started = time.perf_counter()
+        found = self.compiled[(pattern, self.flags)].search(text) is not None
+        costs.append((step, time.perf_counter() - started))
+        return found
+
+
+def _regex_worker(conn, progress):
+    """正则工作进程: 处理 ('build', 正则, flags, 隔离的正则) 与 ('search', 文本, 跳过的正则) 请求"""
+    index = RegexIndex()
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if request[0] == 'build':
+            _, patterns, flags, isolated = request
+            index.build(patterns, flags, isolated)
+            conn.send([list(names.values()) for _, names in index.programs])
+        else:
+            _, text, skip = request
+            progress.value = 0
+            conn.send(index.search(text, progress, set(skip)))
+
+
+class RegexSandbox:
+    """在独立进程中执行用户正则，每条消息有时间预算
+
+    Python 正则执行中途无法取消，超时后直接结束工作进程并重启。进程在每一步前记录位置，
+    超时时据此定位: 合并组超时则把组内正则拆出来单独执行并排在最后；单个正则超时计一次，
+    本条消息跳过它重试，累计 max_strikes 次后交由调用方停用。
+
+    子进程启动时会重新执行本模块 (spawn 下连同 telegram 一起导入，约 0.3~0.5 秒)。为此优先使用
+    forkserver 并预先导入 telegram，同时始终备好一个已启动的备用进程: 结束超时的进程后直接换上备用进程，
+    重启只需重新编译正则 (通常几毫秒)，新的备用进程在后台启动。备用进程尚未就绪时 (如连续超时) 才需要等待
+    进程启动。本条消息用完重试次数或进程异常后，工作进程在后台预先启动，不计入下一条消息。
+    单条消息最坏耗时约 MAX_ATTEMPTS × (预算 + 重启)，备用进程就绪时约 3 × (200ms + 编译)，否则每次重启
+    再加上进程启动时间；期间其他消息的正则匹配排队等待。/status 中显示最近与最长的重启耗时。
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, budget_seconds: float = 0.2, max_strikes: int = 3):
+        self.budget_seconds = budget_seconds
+        self.max_strikes = max_strikes
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(method)
+        if method == 'forkserver':
+            self.context.set_forkserver_preload(['telegram', 'telegram.ext'])
+        self.process = None
+        # 已启动、尚未使用的备用进程 (process, conn, progress)
+        self.standby: Optional[tuple] = None
+        self.conn = None
+        self.progress = None
+        self.lock = asyncio.Lock()
+        self.patterns: List[str] = []
+        self.flags = 0
+        self.chunks: List[List[str]] = []
+        # 曾经超时、需要单独执行的正则
+        self.isolated: Set[str] = set()
+        self.strikes: Counter = Counter()
+        # 正则或合并组 -> [执行次数, 总耗时, 最长耗时, 超时次数]
+        self.costs: Dict[str, list] = {}
+        self.stale = True
+        self.timeouts = 0
+        self.restarts = 0
+        self.disabled = 0
+        self.restart_ms = 0.0
+        self.max_restart_ms = 0.0
+        self.warm_task: Optional[asyncio.Task] = None
+        # 无法启动工作进程时退回主进程内执行 (没有时间预算)
+        self.local: Optional[RegexIndex] = None
+
+    def load(self, patterns: List[str], flags: int):
+        """正则集合变化后调用，下一次搜索前重建"""
+        self.patterns = list(patterns)
+        self.flags = flags
+        current = set(self.patterns)
+        self.isolated &= current
+        self.costs = {label: cost for label, cost in self.costs.items() if label in current}
+        self.stale = True
+
+    def _spawn(self) -> tuple:
+        parent, child = self.context.Pipe()
+        progress = self.context.Value('i', 0, lock=False)
+        process = self.context.Process(target=_regex_worker, args=(child, progress), daemon=True)
+        process.start()
+        child.close()
+        return process, parent, progress
+
+    def _start(self):
+        """换上备用进程 (没有可用的备用进程时现场启动)，并在后台启动新的备用进程"""
+        standby, self.standby = self.standby, None
+        if standby is not None and standby[0].is_alive():
+            self.process, self.conn, self.progress = standby
+        else:
+            if standby is not None:
+                standby[1].close()
+            self.process, self.conn, self.progress = self._spawn()
+        self.stale = True
+        try:
+            self.standby = self._spawn()
+        except OSError as e:
+            logger.warning(f"无法启动备用正则工作进程: {e}")
+
+    def _stop(self, standby: bool = False):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(5)
+            self.conn.close()
+            self.process = None
+        if standby and self.standby is not None:
+            process, conn, _ = self.standby
+            process.terminate()
+            process.join(5)
+            conn.close()
+            self.standby = None
+
+    def _call(self, request: tuple, timeout: float):
+        self.conn.send(request)
+        if not self.conn.poll(timeout):
+            raise TimeoutError
+        return self.conn.recv()
+
+    def _ensure(self) -> bool:
+        """在线程中执行: 必要时启动进程并重建索引，无法启动进程时改为本进程执行并返回 False"""
+        started = time.perf_counter()
+        restarted = self.process is None or not self.process.is_alive()
+        if restarted:
+            self._stop()
+            try:
+                self._start()
+            except OSError as e:
+                logger.warning(f"无法启动正则工作进程，改为在主进程中执行 (没有时间预算): {e}")
+                self.local = RegexIndex()
+                self.stale = True
+                return False
+        if self.stale:
+            try:
+                self.chunks = self._call(('build', self.patterns, self.flags, list(self.isolated)), 30)
+            except TimeoutError:
+                # 与搜索超时区分，不据此定位正则
+                self._stop()
+                raise OSError("重建正则索引超时")
+            self.costs = {label: cost for label, cost in self.costs.items() if not label.startswith("合并组")}
+            self.stale = False
+        if restarted and self.restarts:
+            self.restart_ms = (time.perf_counter() - started) * 1000
+            self.max_restart_ms = max(self.max_restart_ms, self.restart_ms)
+        return True
+
+    def _search(self, text: str, skip: List[str]):
+        """在线程中执行: 必要时启动进程并重建索引，然后搜索"""
+        if not self._ensure():
+            return None
+        return self._call(('search', text, skip), self.budget_seconds)
+
+    async def warm_up(self):
+        """预先启动工作进程并建好索引 (启动时与超时结束进程后)"""
+        async with self.lock:
+            if self.local is not None or not self.patterns:
+                return
+            try:
+                await asyncio.to_thread(self._ensure)
+            except (OSError, EOFError) as e:
+                logger.error(f"正则工作进程异常: {e}")
+                await asyncio.to_thread(self._stop)
+
+    def _schedule_warm_up(self):
+        if self.process is None and (self.warm_task is None or self.warm_task.done()):
+            self.warm_task = asyncio.create_task(self.warm_up())
+
+    def _label(self, step: int) -> str:
+        if step < 0:
+            return f"合并组{-step} ({len(self.chunks[-step - 1])}个)"
+        return self.patterns[step - 1]
+
+    def _record(self, step: int, seconds: float, timeout: bool = False):
+        cost = self.costs.setdefault(self._label(step), [0, 0.0, 0.0, 0])
+        cost[0] += 1
+        cost[1] += seconds
+        cost[2] = max(cost[2], seconds)
+        cost[3] += timeout
+
+    def _blame(self) -> Optional[str]:
+        """超时后结束进程，按记录的位置定位正则，返回单个超时的正则"""
+        step = self.progress.value
+        self._stop()
+        self.timeouts += 1
+        self.restarts += 1
+        if step == 0:
+            return None
+        self._record(step, self.budget_seconds, timeout=True)
+        if step < 0:
+            self.isolated.update(self.chunks[-step - 1])
+            self.stale = True
+            return None
+        pattern = self.patterns[step - 1]
+        self.strikes[pattern] += 1
+        if pattern not in self.isolated:
+            self.isolated.add(pattern)
+            self.stale = True
+        return pattern
+
+    async def search(self, text: str) -> Tuple[List[str], List[str]]:
+        """返回 (命中的正则, 多次超时应停用的正则)"""
+        if not self.patterns:
+            return [], []
+        disabled = []
+        skip: List[str] = []
+        async with self.lock:
+            for _ in range(self.MAX_ATTEMPTS):
+                if self.local is not None:
+                    if self.stale:
+                        self.local.build(self.patterns, self.flags)
+                        self.stale = False
+                    return self.local.search(text)[0], disabled
+                try:
+                    result = await asyncio.to_thread(self._search, text, skip)
+                except TimeoutError:
+                    REGEX_TIMEOUTS.inc()
+                    pattern = await asyncio.to_thread(self._blame)
+                    if pattern is not None:
+                        skip.append(pattern)
+                        logger.warning(f"正则超出时间预算 ({self.strikes[pattern]}/{self.max_strikes}): {pattern}")
+                        if self.strikes[pattern] >= self.max_strikes:
+                            del self.strikes[pattern]
+                            self.disabled += 1
+                            disabled.append(pattern)
+                    continue
+                except (OSError, EOFError) as e:
+                    logger.error(f"正则工作进程异常: {e}")
+                    await asyncio.to_thread(self._stop)
+                    self._schedule_warm_up()
+                    return [], disabled
+                if result is None:
+                    continue
+                matched, costs = result
+                for step, seconds in costs:
+                    self._record(step, seconds)
+                return matched, disabled
+        logger.warning("正则匹配多次超时，本条消息跳过剩余的正则")
+        self._schedule_warm_up()
+        return [], disabled
+
+    def close(self):
+        if self.warm_task and not self.warm_task.done():
+            self.warm_task.cancel()
+        self._stop(standby=True)
+
+    def describe(self, limit: int = 5) -> str:
+        """正则执行情况与耗时最高的正则"""
+        lines = [f"• 正则: {len(self.patterns)} 个，{len(self.chunks)} 组合并，{len(self.isolated)} 个隔离执行，"
+                 f"预算 {self.budget_seconds * 1000:.0f}ms",
+                 f"• 超时 {self.timeouts} 次，重启进程 {self.restarts} 次 (最近 {self.restart_ms:.0f}ms，"
+                 f"最长 {self.max_restart_ms:.0f}ms)，自动停用 {self.disabled} 个"]
+        ranked = sorted(self.costs.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        for label, (calls, total, longest, timeouts) in ranked:
+            lines.append(f"  - {label}: {calls}次，平均 {total / calls * 1000:.2f}ms，"
+                         f"最长 {longest * 1000:.1f}ms，超时 {timeouts}次")
+        return "\n".join(lines)
+
+
+class KeywordIndex:
+    """关键词索引: 全局与个人的完全匹配关键词去重后编入同一个自动机
+
+    每个关键词对应其订阅者，匹配时只为命中的关键词查找订阅者。增删关键词只更新对应用户的
+    订阅关系；关键词集合本身变化时自动机标记为过期，在下一次匹配时重建。
+    """
+
+    def __init__(self, case_sensitive: bool = False):
+        self.case_sensitive = case_sensitive
+        # 归一化关键词 -> 原始写法 (全局关键词)
+        self.global_keywords: Dict[str, List[str]] = {}
+        # 归一化关键词 -> {user_id: 原始写法}
+        self.subscribers: Dict[str, Dict[int, List[str]]] = {}
+        # user_id -> {归一化关键词: 原始写法}，用于增量更新
+        self.user_exact: Dict[int, Dict[str, List[str]]] = {}
+        # user_id -> 正则关键词
+        self.user_regex: Dict[int, List[str]] = {}
+        # 正则关键词 -> 订阅者 (正则由 RegexSandbox 执行，集合变化时标记 regex_stale)
+        self.regex_subscribers: Dict[str, Set[int]] = {}
+        self.regex_stale = True
+        self.automaton: Optional[KeywordAutomaton] = None
+        self.rebuilds = 0
+
+    def _normalize(self, keyword: str) -> str:
+        return keyword if self.case_sensitive else keyword.lower()
+
+    @property
+    def regex_flags(self) -> int:
+        return 0 if self.case_sensitive else re.IGNORECASE
+
+    def load(self, config: dict):
+        """从配置全量构建 (启动或切换大小写时)"""
+        self.case_sensitive = config.get('settings', {}).get('case_sensitive', False)
+        self.global_keywords = {}
+        self.subscribers = {}
+        self.user_exact = {}
+        self.user_regex = {}
+        self.regex_subscribers = {}
+        self.sync_global(config.get('keywords', []))
+        for user_id, entries in config.get('user_keywords', {}).items():
+            self.sync_user(user_id, entries)
+        self.automaton = None
+        self.regex_stale = True
+
+    def sync_global(self, keywords: List[str]):
+        """按当前的全局关键词列表更新索引"""
+        patterns: Dict[str, List[str]] = {}
+        for keyword in keywords:
+            pattern = self._normalize(keyword)
+            if pattern:
+                patterns.setdefault(pattern, []).append(keyword)
+        changed = patterns.keys() ^ self.global_keywords.keys()
+        self.global_keywords = patterns
+        if any(pattern not in self.subscribers for pattern in changed):
+            self.automaton = None
+
+    def sync_user(self, user_id, entries: List[dict]):
+        """按某个用户当前的关键词列表增量更新索引"""
+        try:
+            uid = int(user_id)
+        except ValueError:
+            return
+        exact: Dict[str, List[str]] = {}
+        regex = []
+        for entry in entries:
+            if not entry.get('enabled', True):
+                continue
+            keyword = entry['keyword']
+            if entry.get('match_type', 'exact') == 'regex':
+                if keyword not in regex:
+                    regex.append(keyword)
+                continue
+            pattern = self._normalize(keyword)
+            if pattern:
+                exact.setdefault(pattern, []).append(keyword)
+
+        old = self.user_exact.get(uid, {})
+        for pattern in old.keys() - exact.keys():
+            users = self.subscribers[pattern]
+            del users[uid]
+            if not users:
+                del self.subscribers[pattern]
+                if pattern not in self.global_keywords:
+                    self.automaton = None
+        for pattern, keywords in exact.items():
+            users = self.subscribers.get(pattern)
+            if users is None:
+                users = self.subscribers[pattern] = {}
+                if pattern not in self.global_keywords:
+                    self.automaton = None
+            users[uid] = keywords
+
+        old_regex = set(self.user_regex.get(uid, ()))
+        for pattern in old_regex.difference(regex):
+            users = self.regex_subscribers[pattern]
+            users.discard(uid)
+            if not users:
+                del self.regex_subscribers[pattern]
+                self.regex_stale = True
+        for pattern in regex:
+            users = self.regex_subscribers.get(pattern)
+            if users is None:
+                users = self.regex_subscribers[pattern] = set()
+                self.regex_stale = True
+            users.add(uid)
+
+        if exact:
+            self.user_exact[uid] = exact
+        else:
+            self.user_exact.pop(uid, None)
+        if regex:
+            self.user_regex[uid] = regex
+        else:
+            self.user_regex.pop(uid, None)
+
+    def match(self, text: str) -> Tuple[List[str], Dict[int, List[str]]]:
+        """返回 (命中的全局关键词, {user_id: 命中的个人完全匹配关键词})"""
+        if self.automaton is None:
+            self.automaton = KeywordAutomaton(list(self.global_keywords.keys() | self.subscribers.keys()))
+            self.rebuilds += 1
+        global_matched: List[str] = []
+        user_matched: Dict[int, List[str]] = {}
+        for pattern in self.automaton.findall(self._normalize(text)):
+            global_matched.extend(self.global_keywords.get(pattern, ()))
+            for uid, keywords in self.subscribers.get(pattern, {}).items():
+                user_matched.setdefault(uid, []).extend(keywords)
+        return global_matched, user_matched
+
+    def describe(self) -> str:
+        """索引规模"""
+        patterns = len(self.global_keywords.keys() | self.subscribers.keys())
+        return f"• 关键词索引: {patterns} 个完全匹配，重建自动机 {self.rebuilds} 次"
+
+
+class SourceIndex:
+    """屏蔽列表与允许的源账号，以集合保存
+
+    blocked_by 是来源 -> 屏蔽了它的用户的倒排索引，一次查找即可得到不应收到本条提醒的用户。
+    配置中的列表仍是唯一的持久化来源，/my 屏蔽、取消屏蔽及管理员修改源账号后调用 sync_* 同步。
+    """
+
+    def __init__(self):
+        self.user_blocked: Dict[int, Set[int]] = {}
+        self.blocked_by: Dict[int, Set[int]] = {}
+        self.allowed_senders: Set[int] = set()
+
+    def load(self, config: dict):
+        """根据配置重建"""
+        self.user_blocked = {}
+        self.blocked_by = {}
+        for user_id, blocked in config.get('user_blocked', {}).items():
+            self.sync_user(user_id, blocked)
+        self.sync_senders(config.get('allowed_senders', []))
+
+    def sync_user(self, user_id, blocked: list):
+        """某个用户的屏蔽列表变化后调用"""
+        try:
+            uid = int(user_id)
+        except ValueError:
+            return
+        new = set(blocked)
+        old = self.user_blocked.get(uid, set())
+        for source_id in old - new:
+            users = self.blocked_by[source_id]
+            users.discard(uid)
+            if not users:
+                del self.blocked_by[source_id]
+        for source_id in new - old:
+            self.blocked_by.setdefault(source_id, set()).add(uid)
+        if new:
+            self.user_blocked[uid] = new
+        else:
+            self.user_blocked.pop(uid, None)
+
+    def sync_senders(self, senders: list):
+        """允许的源账号变化后调用"""
+        self.allowed_senders = set(senders)
+
+    def blocked_users(self, source_id: Optional[int]) -> Set[int]:
+        """屏蔽了该来源的用户"""
+        if not source_id:
+            return set()
+        return self.blocked_by.get(source_id, set())
+
+    def is_allowed_sender(self, sender_id: int) -> bool:
+        """未设置源账号时允许所有人"""
+        return not self.allowed_senders or sender_id in self.allowed_senders
+
+
+class ConfigWriter:
+    """配置写入: 合并短时间内的多次保存，在线程中写临时文件后原子替换，并保留最近几份备份"""
+
+    def __init__(self, path: str, debounce_seconds: float = 1.0, backups: int = 3, indent: int = 2):
+        self.path = path
+        self.debounce_seconds = debounce_seconds
+        self.backups = backups
+        self.indent = indent
+        self.pending: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    def save(self, config: dict):
+        """登记一次修改，稍后写入"""
+        self.pending = config
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.debounce_seconds)
+        await self.flush()
+
+    async def flush(self):
+        """立即写入尚未保存的修改"""
+        async with self.lock:
+            while self.pending is not None:
+                # 序列化在事件循环中完成，避免与配置修改并发
+                data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+                self.pending = None
+                await asyncio.to_thread(self._write, data)
+
+    async def close(self):
+        """取消等待中的延迟写入，立即写入剩余修改"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush()
+
+    def flush_sync(self):
+        """同步写入，用于启动阶段"""
+        if self.pending is not None:
+            data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+            self.pending = None
+            self._write(data)
+
+    def _write(self, data: str):
+        try:
+            self._rotate_backups()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._fsync_directory(directory)
+        except Exception as e:
+            logger.error(f"保存配置文件失败: {e}")
+
+    def _rotate_backups(self):
+        """config.json.1 为最近一次的备份，编号越大越旧"""
+        if self.backups <= 0 or not os.path.exists(self.path):
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        shutil.copy2(self.path, f"{self.path}.1")
+
+    @staticmethod
+    def _fsync_directory(directory: str):
+        """确保替换操作落盘 (Windows 不支持打开目录，忽略)"""
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def describe(self) -> str:
+        """写入次数与耗时"""
+        return f"• 配置写入: {self.writes} 次，最近 {self.last_ms:.1f}ms，最长 {self.max_ms:.1f}ms"
+
+
+# Telegram 官方限制: 全局约 30 条/秒，同一私聊约 1 条/秒
+TELEGRAM_GLOBAL_PER_SECOND = 30
+TELEGRAM_PER_CHAT_PER_SECOND = 1
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """获取 RetryAfter 要求的等待秒数"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """令牌桶"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        """按时间补充令牌"""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, cost: float = 1) -> float:
+        """获取 cost 个令牌需要等待的秒数，为 0 时表示可立即获取"""
+        now = time.monotonic()
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        wait = 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, cost: float = 1):
+        """扣除令牌 (检查与扣除之间可能隔着等待，先补充到当前时间)"""
+        self._refill(time.monotonic())
+        self.tokens -= min(cost, self.capacity)
+
+    def block(self, seconds: float):
+        """在指定时间内暂停发放令牌 (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class AlertDispatcher:
+    """提醒发送器: 多个协程并发发送，受全局令牌桶与每个用户的令牌桶限速
+
+    处理消息时只把提醒放入该用户的队列，不等待发送完成。同一用户的提醒按顺序逐条发送，
+    需要等待令牌的用户延后重新排队，不占用发送协程，热门关键词的大量订阅者也不会互相阻塞。
+    """
+
+    def __init__(self, settings: dict):
+        global_rate = min(settings.get('alert_per_second', TELEGRAM_GLOBAL_PER_SECOND), TELEGRAM_GLOBAL_PER_SECOND)
+        # 容量为 1: 均匀发送，任意一秒内都不超过 global_rate 条
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.global_lock = asyncio.Lock()
+        self.per_chat_rate = settings.get('alert_per_chat_per_second', TELEGRAM_PER_CHAT_PER_SECOND)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # 用户 -> 待发送的提醒 [(文本, 按钮, 收到消息的时间, 已遇到 RetryAfter 的次数)]
+        self.chat_queues: Dict[int, deque] = {}
+        # 可以尝试发送的用户
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.concurrency = max(1, int(settings.get('alert_concurrency', 20)))
+        self.max_retries = settings.get('alert_retry_after_retries', 3)
+        self.max_pending = settings.get('alert_queue_limit', 10000)
+        self.bot = None
+        self.workers: List[asyncio.Task] = []
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.retry_after_count = 0
+        self.dropped = 0
+
+    def start(self, bot):
+        """启动发送协程"""
+        self.bot = bot
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self, timeout: float = 10):
+        """等待队列中的提醒发送完 (最多 timeout 秒) 后停止"""
+        if self.workers and self.pending:
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"退出时仍有 {self.pending} 条提醒未发送")
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, chat_id: int, text: str, reply_markup, received_at: float):
+        """放入发送队列，received_at 为收到消息时的 time.monotonic()"""
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            ALERT_FAILURES.inc(1, ('QueueFull',))
+            logger.error(f"提醒队列已满 ({self.pending})，丢弃发给用户 {chat_id} 的提醒")
+            return
+        self.pending += 1
+        self.idle.clear()
+        queue = self.chat_queues.get(chat_id)
+        if queue is None:
+            queue = self.chat_queues[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        queue.append((text, reply_markup, received_at, 0))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1)
+        return bucket
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self.ready.get()
+            wait = self._chat_bucket(chat_id).wait_time()
+            if wait > 0:
+                loop.call_later(wait, self.ready.put_nowait, chat_id)
+                continue
+            queue = self.chat_queues[chat_id]
+            alert = queue.popleft()
+            try:
+                retry = await self._deliver(chat_id, *alert)
+            except Exception as e:
+                logger.error(f"发送提醒到用户 {chat_id} 失败: {e}")
+                retry = None
+            if retry is not None:
+                queue.appendleft(retry)
+            else:
+                self.pending -= 1
+                if not self.pending:
+                    self.idle.set()
+            if queue:
+                self.ready.put_nowait(chat_id)
+            else:
+                del self.chat_queues[chat_id]
+
+    async def _deliver(self, chat_id: int, text: str, reply_markup, received_at: float, attempts: int):
+        """发送一条提醒，遇到 RetryAfter 时返回需要重新排队的提醒"""
+        async with self.global_lock:
+            while True:
+                wait = self.global_bucket.wait_time()
+                if wait <= 0:
+                    self.global_bucket.consume()
+                    break
+                await asyncio.sleep(wait)
+        # 同一用户同时只有一条在发送，拿到全局令牌后再扣除该用户的令牌
+        self._chat_bucket(chat_id).consume()
+
+        started = time.monotonic()
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        except Exception as e:
+            ALERT_SEND_SECONDS.observe(time.monotonic() - started, ('error',))
+            if isinstance(e, RetryAfter) and attempts < self.max_retries:
+                self.retry_after_count += 1
+                wait = retry_after_seconds(e)
+                # 已按每个用户限速，仍被限流通常说明整体发送过快，全局一并暂停
+                self._chat_bucket(chat_id).block(wait)
+                self.global_bucket.block(wait)
+                logger.warning(f"触发限流 -> {chat_id}，{wait:.0f}秒后重试 ({attempts + 1}/{self.max_retries})")
+                return text, reply_markup, received_at, attempts + 1
+            ALERT_FAILURES.inc(1, (type(e).__name__,))
+            raise
+
+        now = time.monotonic()
+        ALERT_SEND_SECONDS.observe(now - started, ('ok',))
+        ALERT_DELIVERY_SECONDS.observe(now - received_at)
+        ALERTS_SENT.inc()
+        logger.info(f"已发送关键词提醒到用户 {chat_id}")
+        return None
+
+    def describe(self) -> str:
+        """队列与送达耗时"""
+        p50 = ALERT_DELIVERY_SECONDS.quantile(0.5)
+        p99 = ALERT_DELIVERY_SECONDS.quantile(0.99)
+        latency = f"P50 {p50:.2f}秒，P99 {p99:.2f}秒" if p50 is not None else "暂无数据"
+        return (f"• 待发送: {self.pending} 条 / {len(self.chat_queues)} 个用户，并发 {self.concurrency}，"
+                f"全局 {self.global_bucket.rate:.0f}/秒，每用户 {self.per_chat_rate:g}/秒\n"
+                f"• 限流 {self.retry_after_count} 次，队列满丢弃 {self.dropped} 条\n"
+                f"• 收到消息到送达: {latency}")
+
+
 class KeywordMonitorBot:
-    def __init__(self, token: str):
+    def __init__(self, token: str, base_url: Optional[str] = None):
         self.token = token
-        self.application = Application.builder(). token(token).build()
         self.db_path = os. path.join(SCRIPT_DIR, "keyword_bot.db")
         self.config_file = os.path.join(SCRIPT_DIR, "keyword_config.json")
+        self.config_writer = ConfigWriter(self.config_file)
 
         self.init_database()
         self.config = self.load_config()
-
-        self.stats = {
-            'messages_received': 0,
-            'keywords_matched': 0,
-            'alerts_sent': 0,
-            'start_time': datetime.now()
-        }
+        self.keyword_index = KeywordIndex()
+        self.keyword_index.load(self.config)
+        self.source_index = SourceIndex()
+        self.source_index.load(self.config)
+        settings = self.config['settings']
+        self.regex_sandbox = RegexSandbox(settings.get('regex_budget_ms', 200) / 1000,
+                                          settings.get('regex_max_strikes', 3))
+        self.alert_dispatcher = AlertDispatcher(settings)
+        self.application = self.build_application(base_url)
+
+        self.start_time = datetime.now()
+        # 指标导出服务 (metrics.enabled 时在 post_init 中启动)
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        METRICS.gauge('keywords', '关键词数量', lambda: {
+            ('global',): len(self.config.get('keywords', [])),
+            ('user',): sum(len(words) for words in self.config.get('user_keywords', {}).values()),
+        }, labelnames=('scope',))
+        METRICS.gauge('notify_users', '接收提醒的用户数', lambda: len(self.config.get('notify_users', [])))
+        METRICS.gauge('alert_queue_depth', '等待发送的提醒数', lambda: self.alert_dispatcher.pending)
 
         self.register_handlers()
 
+    def build_application(self, base_url: Optional[str] = None) -> Application:
+        """创建 Application，base_url 可指向自建或离线测试用的 Bot API"""
+        builder = Application.builder().token(self.token)
+        if base_url:
+            builder = builder.base_url(base_url)
+        concurrent_updates = int(self.config['settings'].get('concurrent_updates', 1))
+        return (
+            builder
+            .concurrent_updates(max(1, concurrent_updates))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+
+    def webhook_options(self) -> dict:
+        """Webhook 启动参数"""
+        webhook = self.config.get('webhook', {})
+        # 未配置密钥时每次启动随机生成，setWebhook 时一并提交给 Telegram
+        secret_token = webhook.get('secret_token') or secrets.token_urlsafe(32)
+        return {
+            'listen': webhook.get('listen', '127.0.0.1'),
+            'port': int(webhook.get('port', 8444)),
+            'url_path': (webhook.get('url_path') or '').strip('/'),
+            'webhook_url': webhook.get('webhook_url') or None,
+            'secret_token': secret_token,
+            'max_connections': int(webhook.get('max_connections', 40)),
+            'allowed_updates': ALLOWED_UPDATES,
+        }
+
     def init_database(self):
         """初始化数据库"""
         conn = sqlite3.connect(self.db_path)
@@ -102,6 +1256,27 @@ class KeywordMonitorBot:
                 "case_sensitive": False,
                 "include_source_info": True,
                 "max_message_length": 500,
+                "concurrent_updates": 1,
+                "regex_budget_ms": 200,
+                "regex_max_strikes": 3,
+                "alert_concurrency": 20,
+                "alert_per_second": 30,
+                "alert_per_chat_per_second": 1,
+                "alert_retry_after_retries": 3,
+            },
+            "webhook": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 8444,
+                "url_path": "",
+                "webhook_url": "",
+                "secret_token": "",
+                "max_connections": 40,
+            },
+            "metrics": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 9109,
             },
         }
 
@@ -125,15 +1300,10 @@ class KeywordMonitorBot:
             return default_config
 
     def save_config(self, config: dict = None):
-        """保存配置文件"""
+        """保存配置文件 (合并短时间内的多次修改，后台写入)"""
         if config is None:
             config = self.config
-
-        try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存配置文件失败: {e}")
+        self.config_writer.save(config)
 
     def register_handlers(self):
         """注册消息处理器"""
@@ -160,10 +1330,7 @@ class KeywordMonitorBot:
 
     async def is_allowed_sender(self, user_id: int) -> bool:
         """检查是否为允许的消息发送者"""
-        allowed = self.config.get("allowed_senders", [])
-        if not allowed:
-            return True
-        return user_id in allowed
+        return self.source_index.is_allowed_sender(user_id)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """开始命令"""
@@ -231,7 +1398,7 @@ class KeywordMonitorBot:
         """状态命令"""
         user_id = update.effective_user.id
 
-        uptime = datetime.now() - self.stats['start_time']
+        uptime = datetime.now() - self.start_time
         uptime_str = str(uptime). split('.')[0]
 
         is_admin = await self.is_admin(user_id)
@@ -243,9 +1410,9 @@ class KeywordMonitorBot:
         status_text = f"""📊 机器人状态
 
 🕐 运行时间: {uptime_str}
-📥 接收消息: {self.stats['messages_received']}
-🔑 关键词匹配: {self.stats['keywords_matched']}
-🔔 发送提醒: {self. stats['alerts_sent']}
+📥 接收消息: {MESSAGES_RECEIVED.value():.0f}
+🔑 关键词匹配: {KEYWORDS_MATCHED.value():.0f}
+🔔 发送提醒: {ALERTS_SENT.value():.0f}
 
 ⚙️ 全局配置:
 • 全局关键词数量: {len(self.config.get('keywords', []))}
@@ -259,6 +1426,11 @@ class KeywordMonitorBot:
 • 个人关键词: {len(user_keywords)} 个
 • 屏蔽列表: {len(user_blocked)} 个"""
 
+        if is_admin:
+            status_text += f"\n\n💾 存储:\n{self.config_writer.describe()}\n{self.keyword_index.describe()}"
+            status_text += f"\n\n🔣 正则执行:\n{self.regex_sandbox.describe()}"
+            status_text += f"\n\n📨 提醒发送:\n{self.alert_dispatcher.describe()}"
+
         await update.message.reply_text(status_text)
 
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -559,6 +1731,7 @@ class KeywordMonitorBot:
         if data == "toggle_case_sensitive":
             self.config['settings']['case_sensitive'] = not self.config['settings']. get('case_sensitive', False)
             self.save_config()
+            self.keyword_index.load(self.config)
             status = "开启" if self.config['settings']['case_sensitive'] else "关闭"
             await query. edit_message_text(text=f"✅ 区分大小写已{status}")
         elif data == "toggle_source_info":
@@ -659,6 +1832,7 @@ class KeywordMonitorBot:
             if block_id_int not in self.config['user_blocked'][user_id_str]:
                 self.config['user_blocked'][user_id_str]. append(block_id_int)
                 self.save_config()
+                self.source_index.sync_user(user_id_str, self.config['user_blocked'][user_id_str])
                 await context.bot.send_message(
                     chat_id=chat_id,
                     text=f"✅ 已将 {block_id} 加入您的屏蔽列表\n该ID发送的消息将不再触发您的提醒"
@@ -750,6 +1924,7 @@ class KeywordMonitorBot:
 
                 if added:
                     self.save_config()
+                    self.keyword_index.sync_user(user_id_str, self.config['user_keywords'][user_id_str])
                     await context.bot.send_message(
                         chat_id=chat_id,
                         text=f"✅ 已添加完全匹配关键词:\n" + '\n'.join(f"• {k}" for k in added)
@@ -783,6 +1958,7 @@ class KeywordMonitorBot:
                 response = ""
                 if added:
                     self.save_config()
+                    self.keyword_index.sync_user(user_id_str, self.config['user_keywords'][user_id_str])
                     response += f"✅ 已添加正则匹配关键词:\n" + '\n'. join(f"• {k}" for k in added)
                 if invalid:
                     response += f"\n\n❌ 以下正则表达式无效:\n" + '\n'.join(f"• {k}" for k in invalid)
@@ -805,6 +1981,7 @@ class KeywordMonitorBot:
 
                 if len(self.config['user_keywords'][user_id_str]) < original_len:
                     self.save_config()
+                    self.keyword_index.sync_user(user_id_str, self.config['user_keywords'][user_id_str])
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已删除关键词: {kw}")
                 else:
                     await context.bot.send_message(chat_id=chat_id, text="❌ 关键词不存在")
@@ -820,6 +1997,7 @@ class KeywordMonitorBot:
                     if bid in self.config['user_blocked'][user_id_str]:
                         self.config['user_blocked'][user_id_str].remove(bid)
                         self.save_config()
+                        self.source_index.sync_user(user_id_str, self.config['user_blocked'][user_id_str])
                         await context.bot.send_message(chat_id=chat_id, text=f"✅ 已从屏蔽列表移除: {bid}")
                     else:
                         await context.bot. send_message(chat_id=chat_id, text="❌ 该ID不在屏蔽列表中")
@@ -851,6 +2029,7 @@ class KeywordMonitorBot:
                         added. append(kw)
                 if added:
                     self.save_config()
+                    self.keyword_index.sync_global(self.config['keywords'])
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加关键词:\n" + '\n'.join(f"• {k}" for k in added))
                 else:
                     await context.bot.send_message(chat_id=chat_id, text="❌ 关键词已存在或无效")
@@ -860,6 +2039,7 @@ class KeywordMonitorBot:
                 if kw in self.config['keywords']:
                     self.config['keywords'].remove(kw)
                     self. save_config()
+                    self.keyword_index.sync_global(self.config['keywords'])
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已删除关键词: {kw}")
                 else:
                     await context.bot.send_message(chat_id=chat_id, text="❌ 关键词不存在")
@@ -913,6 +2093,7 @@ class KeywordMonitorBot:
                         pass
                 if added:
                     self.save_config()
+                    self.source_index.sync_senders(self.config['allowed_senders'])
                     await context.bot.send_message(
                         chat_id=chat_id,
                         text=f"✅ 已添加源账号:\n" + '\n'.join(f"• {s}" for s in added)
@@ -926,6 +2107,7 @@ class KeywordMonitorBot:
                     if sender_id in self.config['allowed_senders']:
                         self. config['allowed_senders'].remove(sender_id)
                         self.save_config()
+                        self.source_index.sync_senders(self.config['allowed_senders'])
                         await context.bot.send_message(chat_id=chat_id, text=f"✅ 已移除源账号: {sender_id}")
                     else:
                         await context.bot.send_message(chat_id=chat_id, text="❌ 该账号不在列表中")
@@ -942,7 +2124,8 @@ class KeywordMonitorBot:
 
     async def process_forwarded_message(self, message: Message):
         """处理转发的消息，检测关键词"""
-        self.stats['messages_received'] += 1
+        MESSAGES_RECEIVED.inc()
+        received_at = time.monotonic()
 
         # 过滤机器人消息
         if message.from_user and message.from_user.is_bot:
@@ -958,12 +2141,14 @@ class KeywordMonitorBot:
         source_info = self._extract_source_info(message)
 
         # 检测关键词
-        matched_results = self._check_all_keywords(text, source_info)
+        started = time.perf_counter()
+        matched_results = await self._check_all_keywords(text, source_info)
+        KEYWORD_MATCH_SECONDS.observe(time.perf_counter() - started)
 
         if matched_results:
-            self.stats['keywords_matched'] += len(matched_results)
+            KEYWORDS_MATCHED.inc(len(matched_results))
             logger.info(f"检测到关键词匹配: {len(matched_results)} 个用户")
-            await self._send_alerts(message, text, matched_results, source_info)
+            await self._send_alerts(message, text, matched_results, source_info, received_at)
 
     def _extract_source_info(self, message: Message) -> dict:
         """提取消息来源信息"""
@@ -1027,73 +2212,72 @@ class KeywordMonitorBot:
 
         return info
 
-    def _check_all_keywords(self, text: str, source_info: dict) -> Dict[int, List[str]]:
+    async def _check_all_keywords(self, text: str, source_info: dict) -> Dict[int, List[str]]:
         """检查所有关键词（全局 + 用户个人），返回 {user_id: [matched_keywords]}"""
         matched_results = {}
-        settings = self.config. get('settings', {})
-        case_sensitive = settings.get('case_sensitive', False)
-
-        check_text = text if case_sensitive else text.lower()
         source_id = source_info. get('chat_id') or source_info.get('user_id')
+        # 一次查找得到屏蔽了该来源的用户
+        blocked = self.source_index.blocked_users(source_id)
 
-        # 检查全局关键词，通知所有提醒用户
-        global_matched = []
-        for keyword in self.config. get('keywords', []):
-            check_keyword = keyword if case_sensitive else keyword.lower()
-            if check_keyword in check_text:
-                global_matched.append(keyword)
+        # 完全匹配关键词一次扫描，正则在工作进程中限时执行，只为命中的关键词查找订阅者
+        global_matched, user_matched = self.keyword_index.match(text)
+        for pattern in await self._search_regex(text):
+            for uid in self.keyword_index.regex_subscribers.get(pattern, ()):
+                user_matched.setdefault(uid, []).append(pattern)
 
+        # 全局关键词通知所有提醒用户
         if global_matched:
             for uid in self.config. get('notify_users', []):
-                user_blocked = self.config.get('user_blocked', {}).get(str(uid), [])
-                if source_id and source_id in user_blocked:
+                if uid in blocked:
                     continue
-                if uid not in matched_results:
-                    matched_results[uid] = []
-                matched_results[uid]. extend(global_matched)
+                matched_results.setdefault(uid, []).extend(global_matched)
 
-        # 检查每个用户的个人关键词
-        for uid_str, user_kw_list in self.config.get('user_keywords', {}).items():
-            try:
-                uid = int(uid_str)
-            except ValueError:
+        for uid, keywords in user_matched.items():
+            if uid in blocked:
                 continue
-
-            user_blocked = self.config.get('user_blocked', {}).get(uid_str, [])
-            if source_id and source_id in user_blocked:
-                continue
-
-            for kw_config in user_kw_list:
-                if not kw_config.get('enabled', True):
-                    continue
-
-                keyword = kw_config['keyword']
-                match_type = kw_config. get('match_type', 'exact')
-
-                matched = False
-                if match_type == 'regex':
-                    try:
-                        pattern = keyword if case_sensitive else keyword
-                        flags = 0 if case_sensitive else re.IGNORECASE
-                        if re.search(pattern, text, flags):
-                            matched = True
-                    except re.error:
-                        pass
-                else:
-                    check_keyword = keyword if case_sensitive else keyword.lower()
-                    if check_keyword in check_text:
-                        matched = True
-
-                if matched:
-                    if uid not in matched_results:
-                        matched_results[uid] = []
-                    if keyword not in matched_results[uid]:
-                        matched_results[uid].append(keyword)
+            results = matched_results.setdefault(uid, [])
+            for keyword in keywords:
+                if keyword not in results:
+                    results.append(keyword)
 
         return matched_results
 
-    async def _send_alerts(self, message: Message, text: str, matched_results: Dict[int, List[str]], source_info: dict):
-        """发送提醒"""
+    def _load_regex(self):
+        """正则关键词变化后交给工作进程重建"""
+        index = self.keyword_index
+        if index.regex_stale:
+            self.regex_sandbox.load(list(index.regex_subscribers), index.regex_flags)
+            index.regex_stale = False
+
+    async def _search_regex(self, text: str) -> List[str]:
+        """执行所有用户正则，多次超时的正则自动停用"""
+        self._load_regex()
+        matched, disabled = await self.regex_sandbox.search(text)
+        for pattern in disabled:
+            self._disable_regex(pattern)
+        return matched
+
+    def _disable_regex(self, pattern: str):
+        """停用超时的正则关键词，通知放入提醒发送队列"""
+        owners = sorted(self.keyword_index.regex_subscribers.get(pattern, ()))
+        for uid in owners:
+            entries = self.config.get('user_keywords', {}).get(str(uid), [])
+            for entry in entries:
+                if entry['keyword'] == pattern and entry.get('match_type') == 'regex':
+                    entry['enabled'] = False
+            self.keyword_index.sync_user(str(uid), entries)
+        self.save_config()
+        logger.warning(f"正则多次超时，已停用: {pattern} (用户 {owners})")
+
+        notice = f"⚠️ 您的正则关键词多次超出执行时间限制，已自动停用:\n{pattern}\n\n请简化后删除并重新添加 (/my)"
+        for uid in owners:
+            self.alert_dispatcher.submit(uid, notice, None, time.monotonic())
+
+    async def _send_alerts(self, message: Message, text: str, matched_results: Dict[int, List[str]], source_info: dict,
+                           received_at: Optional[float] = None):
+        """生成提醒并放入发送队列"""
+        if received_at is None:
+            received_at = time.monotonic()
         settings = self.config.get('settings', {})
         max_length = settings.get('max_message_length', 500)
 
@@ -1143,16 +2327,10 @@ class KeywordMonitorBot:
 
                 reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
 
-                await self.application.bot.send_message(
-                    chat_id=uid,
-                    text=alert_text,
-                    reply_markup=reply_markup
-                )
-                self.stats['alerts_sent'] += 1
-                logger.info(f"已发送关键词提醒到用户 {uid}")
+                self.alert_dispatcher.submit(uid, alert_text, reply_markup, received_at)
 
             except Exception as e:
-                logger.error(f"发送提醒到用户 {uid} 失败: {e}")
+                logger.error(f"生成提醒失败 (用户 {uid}): {e}")
 
         # 记录日志
         self._log_match(matched_results, text, source_info)
@@ -1160,6 +2338,7 @@ class KeywordMonitorBot:
     def _log_match(self, matched_results: Dict[int, List[str]], text: str, source_info: dict):
         """记录匹配日志"""
         try:
+            started = time.perf_counter()
             conn = sqlite3.connect(self. db_path)
             cursor = conn.cursor()
 
@@ -1186,14 +2365,45 @@ class KeywordMonitorBot:
 
             conn.commit()
             conn.close()
+            SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started, ('keyword_logs',))
         except Exception as e:
             logger.error(f"记录匹配日志失败: {e}")
 
+    async def post_init(self, application: Application):
+        """启动提醒发送协程、正则工作进程与指标导出服务"""
+        self.alert_dispatcher.start(application.bot)
+        self._load_regex()
+        self.regex_sandbox.warm_task = asyncio.create_task(self.regex_sandbox.warm_up())
+        metrics = self.config.get('metrics', {})
+        if metrics.get('enabled'):
+            listen, port = metrics.get('listen', '127.0.0.1'), int(metrics.get('port', 9109))
+            try:
+                self.metrics_server = await METRICS.serve(listen, port)
+                logger.info(f"✅ 指标导出: http://{listen}:{port}/metrics")
+            except OSError as e:
+                logger.error(f"启动指标导出失败 ({listen}:{port}): {e}")
+
+    async def post_shutdown(self, application: Application):
+        """退出前发送完队列中的提醒并写入尚未保存的配置"""
+        await self.alert_dispatcher.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        await asyncio.to_thread(self.regex_sandbox.close)
+        await self.config_writer.close()
+
     def run(self):
         """运行机器人"""
         print(BANNER)
         logger.info("关键词监听机器人启动中...")
-        self.application.run_polling()
+        if self.config['webhook'].get('enabled'):
+            options = self.webhook_options()
+            if not options['webhook_url']:
+                logger.warning("未设置 webhook_url，Telegram 只接受 HTTPS 地址，请在反向代理后配置公网地址")
+            logger.info(f"Webhook 模式: 监听 {options['listen']}:{options['port']}/{options['url_path']}")
+            self.application.run_webhook(**options)
+        else:
+            self.application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -1218,7 +2428,28 @@ if __name__ == "__main__":
             "settings": {
                 "case_sensitive": False,
                 "include_source_info": True,
-                "max_message_length": 500
+                "max_message_length": 500,
+                "concurrent_updates": 1,
+                "regex_budget_ms": 200,
+                "regex_max_strikes": 3,
+                "alert_concurrency": 20,
+                "alert_per_second": 30,
+                "alert_per_chat_per_second": 1,
+                "alert_retry_after_retries": 3
+            },
+            "webhook": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 8444,
+                "url_path": "",
+                "webhook_url": "",
+                "secret_token": "",
+                "max_connections": 40
+            },
+            "metrics": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 9109
             }
         }
         with open(config_file, 'w', encoding='utf-8') as f:
@@ -0,0 +1,667 @@
+# benchmark.py - 4.0 转发机器人性能测试
+# 功能: 离线测试转发机器人各环节的耗时，无需连接 Telegram
+# 用法: python3 benchmark.py [--json 结果文件] keywords [--counts 10 100 1000 5000]
+#       python3 benchmark.py [--json 结果文件] paraphrase [--counts 10 100 500 1000]
+#       python3 benchmark.py [--json 结果文件] webhook [--updates 500] [--latency 0.05]
+#       python3 benchmark.py [--json 结果文件] pipeline [--posts 300] [--targets 3] [--error-rate 0.02]
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import string
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot as bot_module
+from bot import KeywordAutomaton, ParaphraseEngine, TelegramForwardBot, ALLOWED_UPDATES, VERSION
+
+
+def random_words(count: int, min_len: int, max_len: int, seed: int) -> list:
+    """生成随机关键词 (中英文混合)"""
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + "广告推广优惠免费代理返利加群私聊福利红包"
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(alphabet) for _ in range(rng.randint(min_len, max_len))))
+    return list(words)
+
+
+def time_per_call(func, text: str, repeat: int) -> float:
+    """单次调用平均耗时 (微秒)"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench_keywords(args) -> dict:
+    """关键词过滤: 逐词扫描 vs 自动机，耗时随关键词数量的变化"""
+    text = ''.join(random_words(1, args.text_length, args.text_length, seed=0))
+    results = []
+
+    print(f"📏 文本长度: {len(text)}，每组重复 {args.repeat} 次")
+    print(f"{'关键词数':>10} {'逐词扫描(µs)':>14} {'自动机(µs)':>12} {'构建(ms)':>10}")
+
+    for count in args.counts:
+        keywords = random_words(count, 3, 8, seed=count)
+
+        def naive(content: str):
+            text_lower = content.lower()
+            for keyword in keywords:
+                if keyword.lower() in text_lower:
+                    return keyword
+            return None
+
+        build_start = time.perf_counter()
+        automaton = KeywordAutomaton(keywords)
+        build_ms = (time.perf_counter() - build_start) * 1000
+
+        naive_us = time_per_call(naive, text, args.repeat)
+        automaton_us = time_per_call(automaton.search, text, args.repeat)
+
+        print(f"{count:>10} {naive_us:>14.1f} {automaton_us:>12.1f} {build_ms:>10.1f}")
+        results.append({
+            'keywords': count,
+            'naive_us': round(naive_us, 2),
+            'automaton_us': round(automaton_us, 2),
+            'build_ms': round(build_ms, 2),
+        })
+
+    return {'text_length': len(text), 'repeat': args.repeat, 'results': results}
+
+
+def bench_paraphrase(args) -> dict:
+    """伪原创替换: 逐条 str.replace vs 单次扫描引擎，耗时随规则数量的变化"""
+    text = ''.join(random_words(1, args.text_length, args.text_length, seed=0))
+    results = []
+
+    print(f"📏 文本长度: {len(text)}，每组重复 {args.repeat} 次")
+    print(f"{'规则数':>10} {'逐条替换(µs)':>14} {'引擎(µs)':>12} {'构建(ms)':>10}")
+
+    for count in args.counts:
+        rules = {word: word.upper() for word in random_words(count, 2, 6, seed=count)}
+
+        def naive(content: str):
+            for old_word, new_word in rules.items():
+                content = content.replace(old_word, new_word)
+            return content
+
+        build_start = time.perf_counter()
+        engine = ParaphraseEngine(rules)
+        build_ms = (time.perf_counter() - build_start) * 1000
+
+        naive_us = time_per_call(naive, text, args.repeat)
+        engine_us = time_per_call(engine.apply, text, args.repeat)
+
+        print(f"{count:>10} {naive_us:>14.1f} {engine_us:>12.1f} {build_ms:>10.1f}")
+        results.append({
+            'rules': count,
+            'naive_us': round(naive_us, 2),
+            'engine_us': round(engine_us, 2),
+            'build_ms': round(build_ms, 2),
+        })
+
+    return {'text_length': len(text), 'repeat': args.repeat, 'results': results}
+
+
+class FakeBotAPI:
+    """最小化的 Bot API 模拟服务，只实现机器人用到的方法
+
+    所有响应延迟 latency 秒；发送类请求按 error_rate 的概率返回 429 (retry_after 秒)。
+    每次成功的发送调用 on_send(method, params)。
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.on_send = None
+        self.errors_injected = 0
+        self.updates = []
+        self.update_event = asyncio.Event()
+        self.calls = Counter()
+        self.next_message_id = 1
+        self.server = None
+        self.port = None
+        self.connections = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        # 结束仍在等待中的长轮询请求并断开所有连接
+        self.update_event.set()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def push_update(self, update: dict):
+        """放入一条待 getUpdates 取走的更新"""
+        self.updates.append(update)
+        self.update_event.set()
+
+    def _message(self, chat_id) -> dict:
+        self.next_message_id += 1
+        return {
+            'message_id': self.next_message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id or 0), 'type': 'channel'},
+        }
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        batch = self.updates[:int(params.get('limit') or 100)]
+        return batch
+
+    @staticmethod
+    def is_send(method: str) -> bool:
+        return method.startswith('send') or method.startswith('copy') or method.startswith('forward')
+
+    async def _dispatch(self, method: str, params: dict):
+        self.calls[method] += 1
+        if self.is_send(method) and self.on_send:
+            self.on_send(method, params)
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'copyMessage':
+            return {'message_id': self._message(params.get('chat_id'))['message_id']}
+        if method == 'sendMediaGroup':
+            return [self._message(params.get('chat_id')) for _ in params.get('media') or [None]]
+        if method.startswith('send') or method.startswith('forward'):
+            return self._message(params.get('chat_id'))
+        return True
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if headers.get('content-type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {}
+                    for key, value in parse_qsl(body.decode()):
+                        try:
+                            params[key] = json.loads(value)
+                        except ValueError:
+                            params[key] = value
+
+                method = path.rsplit('/', 1)[-1]
+                if self.is_send(method) and self.error_rate and self.rng.random() < self.error_rate:
+                    self.errors_injected += 1
+                    status = b'429 Too Many Requests'
+                    response = {'ok': False, 'error_code': 429,
+                                'description': f"Too Many Requests: retry after {self.retry_after}",
+                                'parameters': {'retry_after': self.retry_after}}
+                else:
+                    status = b'200 OK'
+                    response = {'ok': True, 'result': await self._dispatch(method, params)}
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = json.dumps(response).encode()
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+
+class WebhookClient:
+    """保持连接的 Webhook 推送客户端，模拟 Telegram 向机器人推送更新"""
+
+    def __init__(self, port: int, path: str, secret_token: str):
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.reader = None
+        self.writer = None
+
+    async def post(self, update: dict) -> int:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        body = json.dumps(update).encode()
+        self.writer.write(
+            f"POST /{self.path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {self.secret_token}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        await self.reader.readexactly(length)
+        return status
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    """构造一条来自源频道的文本消息更新"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'bench'},
+            'text': f"benchmark message {update_id}",
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+SOURCE_CHAT = -1001
+
+
+@asynccontextmanager
+async def running_bot(api: FakeBotAPI, targets: list, forward_settings: dict, record=None):
+    """在临时目录中启动一个指向模拟 Bot API 的机器人 (不含更新接收方式)"""
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with open("bot_config.json", 'w', encoding='utf-8') as f:
+            json.dump({
+                "bot_token": "123:bench",
+                "source_channels": [SOURCE_CHAT],
+                "target_channels": targets,
+                "forward_settings": forward_settings,
+                "notification_settings": {"notify_admin_on_error": False},
+            }, f)
+        bot = TelegramForwardBot("123:bench", base_url=api.base_url)
+        settings = bot.config['forward_settings']
+        bot.media_group_handler.timeout_seconds = settings['media_group_timeout']
+        bot.media_group_handler.min_wait_seconds = settings['media_group_min_wait']
+        app = bot.application
+        if record:
+            app.add_handler(TypeHandler(Update, record), group=-1)
+
+        await app.initialize()
+        await bot.post_init(app)
+        await app.start()
+        try:
+            yield bot
+        finally:
+            if app.updater.running:
+                await app.updater.stop()
+            await app.stop()
+            await bot.post_shutdown(app)
+            await app.shutdown()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def measure_ingest(mode: str, args) -> dict:
+    """测量一种接收方式: 单条延迟 (逐条发送) 与突发吞吐 (一次性发送)"""
+    api = FakeBotAPI(args.latency)
+    await api.start()
+    waiters = {}
+
+    async def record(update: Update, context):
+        waiter = waiters.pop(update.update_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(time.perf_counter())
+
+    try:
+        async with running_bot(api, [-1002], {"concurrent_updates": args.concurrent_updates}, record) as bot:
+            app = bot.application
+            clients = []
+            if mode == 'polling':
+                await app.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES)
+
+                async def deliver(update: dict, client_index: int):
+                    api.push_update(update)
+            else:
+                options = bot.webhook_options()
+                options.update(port=free_port(), url_path='webhook', webhook_url=None)
+                await app.updater.start_webhook(**options)
+                clients = [WebhookClient(options['port'], options['url_path'], options['secret_token'])
+                           for _ in range(args.connections)]
+
+                async def deliver(update: dict, client_index: int):
+                    # 模拟 Telegram 到机器人的网络延迟
+                    if args.latency:
+                        await asyncio.sleep(args.latency)
+                    await clients[client_index].post(update)
+
+            update_id = 1
+            loop = asyncio.get_running_loop()
+
+            # 单条延迟: 逐条发送，等待处理器收到后再发下一条
+            latencies = []
+            for _ in range(args.samples):
+                waiter = waiters[update_id] = loop.create_future()
+                sent = time.perf_counter()
+                await deliver(make_update(update_id, SOURCE_CHAT), 0)
+                latencies.append((await waiter - sent) * 1000)
+                update_id += 1
+
+            # 突发吞吐: 一次性发送 updates 条
+            futures = []
+            for i in range(args.updates):
+                waiters[update_id + i] = loop.create_future()
+                futures.append(waiters[update_id + i])
+            start = time.perf_counter()
+            if mode == 'polling':
+                for i in range(args.updates):
+                    api.push_update(make_update(update_id + i, SOURCE_CHAT))
+            else:
+                async def sender(index: int):
+                    for i in range(index, args.updates, args.connections):
+                        await deliver(make_update(update_id + i, SOURCE_CHAT), index)
+                await asyncio.gather(*(sender(i) for i in range(args.connections)))
+            finished = max(await asyncio.gather(*futures))
+            elapsed = finished - start
+
+            for client in clients:
+                await client.close()
+    finally:
+        await api.stop()
+
+    return {
+        'mode': mode,
+        'latency_p50_ms': round(percentile(latencies, 0.5), 2),
+        'latency_p99_ms': round(percentile(latencies, 0.99), 2),
+        'updates_per_second': round(args.updates / elapsed, 1),
+        'api_calls': dict(api.calls),
+    }
+
+
+def bench_webhook(args) -> dict:
+    """更新接收: 长轮询 vs Webhook，基于本地模拟的 Bot API"""
+    # 逐条消息的 INFO 日志会干扰计时
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"🌐 模拟网络延迟 {args.latency * 1000:.0f}ms，延迟样本 {args.samples} 条，突发 {args.updates} 条")
+    print(f"{'方式':>8} {'p50(ms)':>9} {'p99(ms)':>9} {'吞吐(条/秒)':>12}")
+
+    results = []
+    for mode in ('polling', 'webhook'):
+        result = asyncio.run(measure_ingest(mode, args))
+        print(f"{mode:>8} {result['latency_p50_ms']:>9.1f} {result['latency_p99_ms']:>9.1f} "
+              f"{result['updates_per_second']:>12.1f}")
+        results.append(result)
+
+    return {
+        'latency': args.latency,
+        'samples': args.samples,
+        'updates': args.updates,
+        'connections': args.connections,
+        'concurrent_updates': args.concurrent_updates,
+        'results': results,
+    }
+
+
+def make_post(post_id: int, kind: str, update_id: int, rng: random.Random) -> list:
+    """构造一条帖子对应的更新 (媒体组为 10 条)，文案中带有 bench-<post_id> 标记"""
+    text = f"bench-{post_id} " + ' '.join(random_words(12, 3, 8, seed=rng.random()))
+    base = {
+        'date': int(time.time()),
+        'chat': {'id': SOURCE_CHAT, 'type': 'supergroup', 'title': 'bench'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'bench'},
+    }
+    if kind == 'text':
+        return [{'update_id': update_id, 'message': {**base, 'message_id': post_id * 16, 'text': text}}]
+
+    count = 10 if kind == 'album' else 1
+    updates = []
+    for k in range(count):
+        message = {
+            **base,
+            'message_id': post_id * 16 + k,
+            'photo': [{'file_id': f"file-{post_id}-{k}", 'file_unique_id': f"uniq-{post_id}-{k}",
+                       'width': 1280, 'height': 720}],
+        }
+        if k == 0:
+            message['caption'] = text
+        if kind == 'album':
+            message['media_group_id'] = f"album-{post_id}"
+        updates.append({'update_id': update_id + k, 'message': message})
+    return updates
+
+
+async def run_pipeline(args) -> dict:
+    """端到端: 从更新进入 getUpdates 到所有目标频道都发送成功"""
+    api = FakeBotAPI(args.latency, args.error_rate, args.retry_after, seed=args.seed)
+    await api.start()
+    rng = random.Random(args.seed)
+    targets = [-2000 - i for i in range(args.targets)]
+    kinds = ['text', 'photo', 'album'] if args.kind == 'mixed' else [args.kind]
+
+    injected = {}
+    delivered = Counter()
+    finished = {}
+    all_done = asyncio.Event()
+    token = re.compile(r'bench-(\d+)')
+
+    def on_send(method: str, params: dict):
+        if method == 'copyMessage':
+            post_id = int(params.get('message_id', 0)) // 16
+        else:
+            match = token.search(json.dumps(params, ensure_ascii=False))
+            if not match:
+                return
+            post_id = int(match.group(1))
+        delivered[post_id] += 1
+        if delivered[post_id] == len(targets) and post_id in injected:
+            finished[post_id] = time.perf_counter()
+            if len(finished) == args.posts:
+                all_done.set()
+
+    api.on_send = on_send
+    forward_settings = {
+        'queue_workers': args.workers,
+        'max_concurrent_sends': args.concurrency,
+        'dedup_enabled': False,
+    }
+    if args.per_minute:
+        forward_settings['max_forwards_per_minute'] = args.per_minute
+    if args.unlimited:
+        # 去掉 Telegram 限速，只测机器人自身的处理开销
+        bot_module.TELEGRAM_GLOBAL_PER_SECOND = 1e9
+        forward_settings.update(max_forwards_per_minute=1e9, per_chat_per_minute=1e9, per_chat_burst=1e9)
+
+    # 指标为模块级计数器，只统计本次运行的增量
+    forwarded_before = bot_module.MESSAGES_FORWARDED.value()
+    failed_before = bot_module.FORWARD_FAILURES.value()
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        async with running_bot(api, targets, forward_settings) as bot:
+            await bot.application.updater.start_polling(poll_interval=0, timeout=10,
+                                                        allowed_updates=ALLOWED_UPDATES)
+            update_id = 1
+            start = time.perf_counter()
+            for post_id in range(1, args.posts + 1):
+                updates = make_post(post_id, kinds[post_id % len(kinds)], update_id, rng)
+                update_id += len(updates)
+                injected[post_id] = time.perf_counter()
+                for update in updates:
+                    api.push_update(update)
+                if args.rate:
+                    await asyncio.sleep(1 / args.rate)
+            try:
+                await asyncio.wait_for(all_done.wait(), args.timeout)
+            except asyncio.TimeoutError:
+                print(f"⚠️ 超时，完成 {len(finished)}/{args.posts}")
+            elapsed = time.perf_counter() - start
+            forwarded = bot_module.MESSAGES_FORWARDED.value() - forwarded_before
+            failed = bot_module.FORWARD_FAILURES.value() - failed_before
+    finally:
+        traced = tracemalloc.get_traced_memory() if args.trace_memory else None
+        if args.trace_memory:
+            tracemalloc.stop()
+        await api.stop()
+
+    latencies = [(finished[p] - injected[p]) * 1000 for p in finished]
+    send_calls = sum(count for method, count in api.calls.items() if FakeBotAPI.is_send(method))
+    result = {
+        'kind': args.kind,
+        'posts': args.posts,
+        'completed': len(finished),
+        'targets': args.targets,
+        'elapsed_s': round(elapsed, 3),
+        'posts_per_second': round(len(finished) / elapsed, 2) if elapsed else 0.0,
+        'latency_p50_ms': round(percentile(latencies, 0.5), 1) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99), 1) if latencies else None,
+        'send_calls_per_post': round(send_calls / max(1, len(finished)), 2),
+        'errors_injected': api.errors_injected,
+        'api_calls': dict(api.calls),
+        'messages_forwarded': int(forwarded),
+        'failed_forwards': int(failed),
+    }
+    if traced:
+        result['memory_current_kib'] = round(traced[0] / 1024, 1)
+        result['memory_peak_kib'] = round(traced[1] / 1024, 1)
+    try:
+        import resource
+        result['max_rss_mib'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except ImportError:
+        pass
+    return result
+
+
+def bench_pipeline(args) -> dict:
+    """转发全流程: 模拟 Bot API + 合成更新，统计吞吐、端到端延迟、API 调用数与内存"""
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"🧪 {args.posts} 条 {args.kind} 帖子 -> {args.targets} 个目标，"
+          f"API 延迟 {args.latency * 1000:.0f}ms，429 注入 {args.error_rate * 100:.1f}%"
+          f"{'，不限速' if args.unlimited else ''}")
+
+    result = asyncio.run(run_pipeline(args))
+
+    print(f"✅ 完成 {result['completed']}/{result['posts']}，耗时 {result['elapsed_s']}秒")
+    print(f"📈 吞吐: {result['posts_per_second']} 帖/秒")
+    print(f"⏱️ 端到端延迟: p50 {result['latency_p50_ms']}ms，p99 {result['latency_p99_ms']}ms")
+    print(f"📡 每帖发送调用: {result['send_calls_per_post']}，注入 429: {result['errors_injected']}")
+    if 'memory_peak_kib' in result:
+        print(f"💾 内存峰值 (tracemalloc): {result['memory_peak_kib']} KiB")
+    if 'max_rss_mib' in result:
+        print(f"💾 进程最大 RSS: {result['max_rss_mib']} MiB")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="4.0 转发机器人性能测试")
+    parser.add_argument('--json', help="将结果保存为 JSON 文件，便于不同版本对比")
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+
+    keywords_parser = subparsers.add_parser('keywords', help="关键词过滤耗时")
+    keywords_parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    keywords_parser.add_argument('--text-length', type=int, default=500)
+    keywords_parser.add_argument('--repeat', type=int, default=200)
+    keywords_parser.set_defaults(func=bench_keywords)
+
+    paraphrase_parser = subparsers.add_parser('paraphrase', help="伪原创替换耗时")
+    paraphrase_parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 500, 1000])
+    paraphrase_parser.add_argument('--text-length', type=int, default=500)
+    paraphrase_parser.add_argument('--repeat', type=int, default=200)
+    paraphrase_parser.set_defaults(func=bench_paraphrase)
+
+    webhook_parser = subparsers.add_parser('webhook', help="长轮询与 Webhook 的接收延迟和吞吐")
+    webhook_parser.add_argument('--samples', type=int, default=100, help="单条延迟样本数")
+    webhook_parser.add_argument('--updates', type=int, default=500, help="突发吞吐测试的更新数")
+    webhook_parser.add_argument('--latency', type=float, default=0.05, help="模拟的网络单程延迟 (秒)")
+    webhook_parser.add_argument('--connections', type=int, default=40, help="Webhook 推送连接数")
+    webhook_parser.add_argument('--concurrent-updates', type=int, default=1)
+    webhook_parser.set_defaults(func=bench_webhook)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="转发全流程的吞吐、延迟与资源占用")
+    pipeline_parser.add_argument('--posts', type=int, default=300)
+    pipeline_parser.add_argument('--kind', choices=['text', 'photo', 'album', 'mixed'], default='mixed')
+    pipeline_parser.add_argument('--targets', type=int, default=3)
+    pipeline_parser.add_argument('--rate', type=float, default=0, help="每秒注入的帖子数，0 为一次性注入")
+    pipeline_parser.add_argument('--latency', type=float, default=0.0, help="模拟 Bot API 响应延迟 (秒)")
+    pipeline_parser.add_argument('--error-rate', type=float, default=0.0, help="发送请求返回 429 的概率")
+    pipeline_parser.add_argument('--retry-after', type=int, default=1)
+    pipeline_parser.add_argument('--workers', type=int, default=4, help="转发队列处理协程数")
+    pipeline_parser.add_argument('--concurrency', type=int, default=10, help="最大并发发送数")
+    pipeline_parser.add_argument('--per-minute', type=int, default=0,
+                                 help="覆盖 max_forwards_per_minute (默认使用机器人的默认配置)")
+    pipeline_parser.add_argument('--unlimited', action='store_true', help="关闭 Telegram 限速")
+    pipeline_parser.add_argument('--trace-memory', action='store_true', help="使用 tracemalloc 统计内存 (较慢)")
+    pipeline_parser.add_argument('--timeout', type=float, default=600)
+    pipeline_parser.add_argument('--seed', type=int, default=0)
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    result = {
+        'suite': args.suite,
+        'version': VERSION,
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        **args.func(args),
+    }
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"✅ 结果已保存: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
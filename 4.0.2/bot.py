@@ -2,19 +2,29 @@
 # 功能: Telegram 转发机器人，支持多频道转发、AI重写、伪原创等功能
 
 import asyncio
+import bisect
 import logging
 import json
 import os
-from datetime import datetime, timedelta
+import time
+import threading
+import hashlib
+import math
+import random
+import secrets
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Set, Optional
 from telegram import Update, Message, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, BadRequest, ChatMigrated, Forbidden, InvalidToken, NetworkError, TimedOut
 import sqlite3
 from pathlib import Path
 import html
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from openai import AsyncOpenAI
 
@@ -27,6 +37,9 @@ BANNER = f"""
 ╚══════════════════════════════════════════════════════════╝
 """
 
+# 机器人实际处理的更新类型，其余类型不再由 Telegram 推送
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 # 配置日志
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -45,55 +58,1506 @@ def escape_markdown_v2(text: str) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
-class MediaGroupHandler:
-    """媒体组处理器"""
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """格式化 Prometheus 标签"""
+    parts = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricCounter:
+    """只增计数器，labels 为与 labelnames 对应的值元组"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels: Optional[tuple] = None) -> float:
+        """指定标签的值，未指定时返回所有标签之和"""
+        if labels is None:
+            return sum(self.values.values())
+        return self.values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        values = self.values or ({(): 0} if not self.labelnames else {})
+        for labels, value in list(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class MetricGauge(MetricCounter):
+    """瞬时值；提供 func 时在导出时调用，返回数值或 {标签元组: 数值}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, func=None, labelnames: tuple = (), kind: str = 'gauge'):
+        super().__init__(name, help_text, labelnames)
+        self.func = func
+        self.kind = kind
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        if self.func is not None:
+            result = self.func()
+            self.values = result if isinstance(result, dict) else {(): result}
+        return super().render()
+
+
+class MetricHistogram:
+    """固定分桶直方图，observe 只做一次二分查找和两次加法"""
+
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-    def __init__(self):
-        self.media_groups: Dict[str, List[Message]] = defaultdict(list)
-        self.group_timers: Dict[str, asyncio.Task] = {}
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数 ..., +Inf 桶计数, 总和]
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels: Optional[tuple] = None) -> int:
+        if labels is None:
+            return sum(sum(series[:-1]) for series in list(self.series.values()))
+        series = self.series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q: float, labels: Optional[tuple] = None) -> Optional[float]:
+        """按分桶估算分位数 (桶内线性插值)，没有数据时返回 None"""
+        if labels is None:
+            all_series = list(self.series.values())
+        else:
+            all_series = [self.series[labels]] if labels in self.series else []
+        counts = [sum(column) for column in zip(*(series[:-1] for series in all_series))]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {series[-1]}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，以 Prometheus 文本格式导出到本地 HTTP 端口"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.metrics: Dict[str, object] = {}
+        # 导出前执行的异步采集函数 (例如需要查询数据库的队列深度)
+        self.collectors: Dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> MetricCounter:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.metrics:
+            self.metrics[full_name] = MetricCounter(full_name, help_text, labelnames)
+        return self.metrics[full_name]
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = MetricHistogram.DEFAULT_BUCKETS) -> MetricHistogram:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self.metrics:
+            self.metrics[full_name] = MetricHistogram(full_name, help_text, labelnames, buckets)
+        return self.metrics[full_name]
+
+    def gauge(self, name: str, help_text: str, func=None, labelnames: tuple = (),
+              kind: str = 'gauge') -> MetricGauge:
+        """注册或替换一个瞬时值指标"""
+        full_name = f"{self.prefix}_{name}"
+        self.metrics[full_name] = MetricGauge(full_name, help_text, func, labelnames, kind)
+        return self.metrics[full_name]
+
+    def add_collector(self, name: str, func):
+        self.collectors[name] = func
+
+    async def collect(self):
+        for name, func in list(self.collectors.items()):
+            try:
+                await func()
+            except Exception as e:
+                logger.error(f"采集指标 {name} 失败: {e}")
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"导出指标 {metric.name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.split()
+            path = parts[1].decode().split('?')[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                await self.collect()
+                body = self.render().encode('utf-8')
+                status = b'200 OK'
+            else:
+                body = b'not found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, listen: str, port: int) -> asyncio.AbstractServer:
+        """在 listen:port 上提供 /metrics"""
+        return await asyncio.start_server(self._handle, listen, port)
+
+
+# 运行指标 (Prometheus 文本格式)，取代原先分散的 stats 计数
+METRICS = MetricsRegistry('forward_bot')
+MESSAGES_RECEIVED = METRICS.counter('messages_received_total', '收到的源频道消息数')
+MESSAGES_FORWARDED = METRICS.counter('messages_forwarded_total', '成功转发的消息数 (按目标计)', ('kind',))
+MEDIA_GROUPS_FORWARDED = METRICS.counter('media_groups_forwarded_total', '成功转发的媒体组数 (按目标计)')
+FORWARD_FAILURES = METRICS.counter('forward_failures_total', '转发失败的消息数 (按目标计)', ('error',))
+FORWARD_RETRIES = METRICS.counter('forward_retries_total', '因临时错误重新排队的发送数', ('error',))
+DEAD_LETTERS = METRICS.counter('dead_letters_total', '写入死信表的发送数', ('reason',))
+DUPLICATES_SUPPRESSED = METRICS.counter('duplicates_suppressed_total', '因重复被跳过的消息数', ('kind',))
+FORWARD_SECONDS = METRICS.histogram('forward_seconds', '单个目标的发送耗时 (含限流等待)', ('kind', 'result'))
+DEEPSEEK_SECONDS = METRICS.histogram('deepseek_request_seconds', 'DeepSeek 重写请求耗时', ('result',))
+SQLITE_WRITE_SECONDS = METRICS.histogram('sqlite_write_seconds', 'SQLite 写事务耗时', ('table',))
+KEYWORD_MATCH_SECONDS = METRICS.histogram(
+    'keyword_match_seconds', '内容类型与关键词过滤耗时',
+    buckets=(0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+
+
+class KeywordAutomaton:
+    """多关键词匹配自动机 (Aho-Corasick)，一次扫描文本即可检查所有关键词"""
+
+    def __init__(self, keywords: List[str], case_sensitive: bool = False):
+        self.case_sensitive = case_sensitive
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Optional[str]] = [None]
+        self.size = 0
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword: str):
+        pattern = keyword if self.case_sensitive else keyword.lower()
+        if not pattern:
+            return
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+            node = nxt
+        if self.output[node] is None:
+            self.output[node] = keyword
+            self.size += 1
+
+    def _build(self):
+        """按广度优先构建失配指针"""
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                fallback = self.goto[state].get(ch, 0)
+                self.fail[child] = fallback if fallback != child else 0
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def search(self, text: str) -> Optional[str]:
+        """返回文本中最先出现的关键词，没有匹配时返回 None"""
+        if not self.size or not text:
+            return None
+        if not self.case_sensitive:
+            text = text.lower()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class ParaphraseEngine:
+    """伪原创替换引擎: 所有规则编译为一棵字典树，单次扫描，同一位置最长匹配优先
+
+    替换结果不会再被其他规则处理，结果与规则顺序无关。
+    """
+
+    _END = ''
+
+    def __init__(self, rules: Dict[str, str]):
+        self.root: dict = {}
+        self.size = 0
+        for old_word, new_word in rules.items():
+            if not old_word:
+                continue
+            node = self.root
+            for ch in old_word:
+                node = node.setdefault(ch, {})
+            node[self._END] = new_word
+            self.size += 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def apply(self, text: str) -> str:
+        """对文本执行全部替换规则"""
+        if not self.size or not text:
+            return text
+
+        root, end_key = self.root, self._END
+        length = len(text)
+        parts = []
+        last = i = 0
+        while i < length:
+            node = root.get(text[i])
+            if node is None:
+                i += 1
+                continue
+
+            # 沿字典树向后匹配，记录最长的完整规则
+            j = i
+            match_end = -1
+            replacement = None
+            while node is not None:
+                j += 1
+                if end_key in node:
+                    match_end = j
+                    replacement = node[end_key]
+                if j >= length:
+                    break
+                node = node.get(text[j])
+
+            if match_end < 0:
+                i += 1
+                continue
+
+            parts.append(text[last:i])
+            parts.append(replacement)
+            i = last = match_end
+
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+
+class MediaItem:
+    """待转发消息的精简记录，只保留转发所需的字段"""
+
+    __slots__ = ('chat_id', 'chat_title', 'message_id', 'media_group_id', 'media_type',
+                 'file_id', 'file_unique_id', 'text', 'date', 'sender_name')
+
+    def __init__(self, chat_id: int, message_id: int, media_type: str, chat_title: Optional[str] = None,
+                 media_group_id: Optional[str] = None, file_id: Optional[str] = None,
+                 file_unique_id: Optional[str] = None, text: str = "", date: float = 0.0,
+                 sender_name: Optional[str] = None):
+        self.chat_id = chat_id
+        self.chat_title = chat_title
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.media_type = media_type
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.text = text
+        self.date = date
+        self.sender_name = sender_name
+
+    @classmethod
+    def from_message(cls, message: Message, media_type: str) -> "MediaItem":
+        """从 Telegram 消息提取记录"""
+        media = None
+        if message.photo:
+            media = message.photo[-1]
+        else:
+            media = (message.video or message.document or message.audio or message.voice
+                     or message.animation or message.sticker)
+
+        return cls(
+            chat_id=message.chat_id,
+            chat_title=message.chat.title,
+            message_id=message.message_id,
+            media_group_id=message.media_group_id,
+            media_type=media_type,
+            file_id=media.file_id if media else None,
+            file_unique_id=media.file_unique_id if media else None,
+            text=message.caption or message.text or "",
+            date=message.date.timestamp() if message.date else time.time(),
+            sender_name=message.from_user.full_name if message.from_user else None,
+        )
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MediaItem":
+        return cls(**{name: data.get(name) for name in cls.__slots__ if name in data})
+
+
+class PendingMediaGroup:
+    """缓冲中的媒体组"""
+
+    __slots__ = ('items', 'first_arrival', 'last_arrival', 'deadline')
+
+    def __init__(self, now: float):
+        self.items: List[MediaItem] = []
+        self.first_arrival = now
+        self.last_arrival = now
+        self.deadline = now
+
+
+class MediaGroupHandler:
+    """媒体组处理器
+
+    由一个调度协程统一管理所有媒体组: 满 10 条 (Telegram 上限) 立即发送，
+    否则在静默窗口内没有新消息到达后发送。静默窗口根据观测到的组内消息间隔自适应，
+    最长不超过 timeout_seconds。
+    缓冲区限制同时打开的媒体组数和消息总数，超出上限或滞留过久的媒体组会被提前发送 (不丢弃，可能只含部分消息)，
+    两种情况分别计数。
+    缓冲区只在内存中，媒体组发送到持久化队列之前进程崩溃会丢失 (最多一个静默窗口内的消息)。
+    """
+
+    MAX_GROUP_SIZE = 10
+
+    def __init__(self, max_open_groups: int = 200, max_buffered_items: int = 1000,
+                 stale_seconds: float = 30.0):
+        self.media_groups: Dict[str, PendingMediaGroup] = {}
+        self.buffered_items = 0
+        self.max_open_groups = max_open_groups
+        self.max_buffered_items = max_buffered_items
+        self.stale_seconds = stale_seconds
+        # 因缓冲区已满 / 滞留过久而提前发送的媒体组数
+        self.capped_groups = 0
+        self.stale_groups = 0
         self.timeout_seconds = 3
+        self.min_wait_seconds = 0.3
+        # 组内消息到达间隔的平滑均值与偏差
+        self.gap_mean: Optional[float] = None
+        self.gap_dev = 0.0
+        self.forward_callback = None
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def quiet_window(self) -> float:
+        """当前静默窗口 (秒)"""
+        if self.gap_mean is None:
+            return self.timeout_seconds
+        window = self.gap_mean + 4 * self.gap_dev
+        return min(self.timeout_seconds, max(self.min_wait_seconds, window))
+
+    def _observe_gap(self, gap: float):
+        """更新到达间隔统计"""
+        if self.gap_mean is None:
+            self.gap_mean = gap
+            self.gap_dev = gap / 2
+        else:
+            self.gap_dev += 0.25 * (abs(gap - self.gap_mean) - self.gap_dev)
+            self.gap_mean += 0.125 * (gap - self.gap_mean)
 
-    async def add_message(self, message: Message, forward_callback):
+    async def add_item(self, item: MediaItem, forward_callback):
         """添加消息到媒体组"""
-        if not message.media_group_id:
-            await forward_callback([message])
+        if not item.media_group_id:
+            await forward_callback([item])
             return
 
-        group_id = message.media_group_id
-        self.media_groups[group_id].append(message)
+        self.forward_callback = forward_callback
+        group_id = item.media_group_id
+        now = time.monotonic()
+
+        group = self.media_groups.get(group_id)
+        if group is None:
+            # 缓冲区已满时提前发送最早的媒体组
+            while self.media_groups and (len(self.media_groups) >= self.max_open_groups
+                                         or self.buffered_items >= self.max_buffered_items):
+                oldest = next(iter(self.media_groups))
+                logger.warning(f"媒体组缓冲区已满，提前发送 {oldest}")
+                self.capped_groups += 1
+                await self._flush(oldest)
+            group = self.media_groups[group_id] = PendingMediaGroup(now)
+        else:
+            self._observe_gap(now - group.last_arrival)
+        group.items.append(item)
+        group.last_arrival = now
+        self.buffered_items += 1
 
-        if group_id in self.group_timers:
-            self.group_timers[group_id].cancel()
+        if len(group.items) >= self.MAX_GROUP_SIZE:
+            await self._flush(group_id)
+            return
 
-        self.group_timers[group_id] = asyncio.create_task(
-            self._process_group_after_timeout(group_id, forward_callback)
-        )
+        group.deadline = min(now + self.quiet_window(), group.first_arrival + self.stale_seconds)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
 
-    async def _process_group_after_timeout(self, group_id: str, forward_callback):
-        """超时后处理媒体组"""
-        await asyncio.sleep(self.timeout_seconds)
+    async def _flush(self, group_id: str):
+        """发送媒体组"""
+        group = self.media_groups.pop(group_id, None)
+        if group is None:
+            return
+        self.buffered_items -= len(group.items)
 
-        if group_id in self.media_groups:
-            messages = self.media_groups[group_id]
-            messages.sort(key=lambda m: m.message_id)
-            await forward_callback(messages)
+        items = sorted(group.items, key=lambda item: item.message_id)
+        try:
+            await self.forward_callback(items)
+        except Exception as e:
+            logger.error(f"媒体组 {group_id} 处理失败: {e}")
+
+    async def _run(self):
+        """调度协程: 发送到期的媒体组，并等待到下一个到期时间"""
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            for group_id, group in list(self.media_groups.items()):
+                if group.deadline <= now:
+                    if now - group.first_arrival >= self.stale_seconds:
+                        logger.warning(f"媒体组 {group_id} 滞留过久，提前发送")
+                        self.stale_groups += 1
+                    await self._flush(group_id)
+
+            timeout = None
+            if self.media_groups:
+                next_deadline = min(group.deadline for group in self.media_groups.values())
+                timeout = max(0.0, next_deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """停止调度协程并立即发送所有未完成的媒体组"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for group_id in list(self.media_groups):
+            await self._flush(group_id)
+
+    def describe(self) -> str:
+        """缓冲区状态"""
+        return (f"• 媒体组缓冲: {len(self.media_groups)} 组 / {self.buffered_items} 条，"
+                f"静默窗口 {self.quiet_window():.1f}秒，提前发送: 缓冲区满 {self.capped_groups}，滞留 {self.stale_groups}")
+
+
+# Telegram 官方限制: 全局约 30 条/秒
+TELEGRAM_GLOBAL_PER_SECOND = 30
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """获取 RetryAfter 要求的等待秒数"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
 
-            del self.media_groups[group_id]
-            if group_id in self.group_timers:
-                del self.group_timers[group_id]
+
+# 永久错误: 目标不存在、无权限、参数错误等，重试也不会成功
+PERMANENT_ERRORS = (BadRequest, Forbidden, InvalidToken, ChatMigrated)
+# 临时错误: 网络异常、超时、限流
+RETRYABLE_ERRORS = (RetryAfter, TimedOut, NetworkError, asyncio.TimeoutError, ConnectionError)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """发送失败是否值得稍后重试 (BadRequest 是 NetworkError 的子类，需先排除)"""
+    if isinstance(error, PERMANENT_ERRORS):
+        return False
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def backoff_delay(retry: int, base: float, cap: float, error: Optional[Exception] = None) -> float:
+    """第 retry 次重试前的等待秒数: 指数退避加随机抖动，且不少于 RetryAfter 要求的时间"""
+    delay = min(cap, base * 2 ** retry)
+    delay = random.uniform(delay / 2, delay)
+    if isinstance(error, RetryAfter):
+        delay = max(delay, retry_after_seconds(error))
+    return delay
+
+
+class TokenBucket:
+    """令牌桶"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        """按时间补充令牌"""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def level(self) -> float:
+        """当前令牌数"""
+        self._refill(time.monotonic())
+        return self.tokens
+
+    def wait_time(self, cost: float) -> float:
+        """获取 cost 个令牌需要等待的秒数，为 0 时表示可立即获取"""
+        now = time.monotonic()
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        wait = 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, cost: float):
+        """扣除令牌"""
+        self.tokens -= min(cost, self.capacity)
+
+    def block(self, seconds: float):
+        """在指定时间内暂停发放令牌 (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SendScheduler:
+    """发送调度器: 全局令牌桶 + 每个目标的令牌桶，突发流量排队平滑发送"""
+
+    def __init__(self, forward_settings: dict):
+        per_minute = forward_settings.get('max_forwards_per_minute', 60)
+        global_rate = min(per_minute / 60, TELEGRAM_GLOBAL_PER_SECOND)
+        self.global_bucket = TokenBucket(global_rate, min(per_minute, TELEGRAM_GLOBAL_PER_SECOND))
+        self.global_lock = asyncio.Lock()
+
+        self.per_chat_rate = forward_settings.get('per_chat_per_minute', 20) / 60
+        self.per_chat_burst = forward_settings.get('per_chat_burst', 3)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.chat_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+        # 仅用于低优先级通道 (管理员通知)，转发的限流重试由队列统一处理
+        self.max_retries = forward_settings.get('max_retry_after_retries', 3)
+        self.concurrency = asyncio.Semaphore(max(1, int(forward_settings.get('max_concurrent_sends', 10))))
+        self.waiting = 0
+        self.retry_after_count = 0
+        # 低优先级通道 (管理员通知) 为转发保留一半全局令牌，且同一时间只发一条
+        self.low_priority_lock = asyncio.Lock()
+        self.low_priority_reserve = self.global_bucket.capacity / 2
+        # 持续转发时低优先级消息最多让路这么久，之后与转发一起按先后排队
+        self.low_priority_max_wait = forward_settings.get('low_priority_max_wait_seconds', 30)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    async def _take(bucket: TokenBucket, lock: asyncio.Lock, cost: float):
+        """按先来后到等待并获取令牌"""
+        async with lock:
+            while True:
+                wait = bucket.wait_time(cost)
+                if wait <= 0:
+                    bucket.consume(cost)
+                    return
+                await asyncio.sleep(wait)
+
+    async def acquire(self, chat_id: int, cost: float = 1):
+        """等待目标频道和全局令牌"""
+        self.waiting += 1
+        try:
+            await self._take(self._chat_bucket(chat_id), self.chat_locks[chat_id], cost)
+            await self._take(self.global_bucket, self.global_lock, cost)
+        finally:
+            self.waiting -= 1
+
+    async def send(self, chat_id: int, send_func, cost: float = 1):
+        """限速发送，遇到 RetryAfter 时暂停该目标并抛出，由调用方按统一的退避策略重新排队"""
+        await self.acquire(chat_id, cost)
+        try:
+            async with self.concurrency:
+                return await send_func()
+        except RetryAfter as e:
+            self.retry_after_count += 1
+            self._chat_bucket(chat_id).block(retry_after_seconds(e))
+            raise
+
+    async def send_low_priority(self, chat_id: int, send_func, cost: float = 1):
+        """低优先级发送: 仅在没有转发排队且全局令牌充足时发送，不占用转发并发数
+
+        让路超过 low_priority_max_wait 秒后不再等待空闲，与转发一起排队获取令牌，避免持续转发时一直发不出去。
+        """
+        attempt = 0
+        async with self.low_priority_lock:
+            deadline = time.monotonic() + self.low_priority_max_wait
+            while True:
+                while True:
+                    if time.monotonic() >= deadline:
+                        await self.acquire(chat_id, cost)
+                        break
+                    chat_bucket = self._chat_bucket(chat_id)
+                    wait = max(chat_bucket.wait_time(cost),
+                               self.global_bucket.wait_time(cost + self.low_priority_reserve))
+                    if self.waiting == 0 and wait <= 0:
+                        chat_bucket.consume(cost)
+                        self.global_bucket.consume(cost)
+                        break
+                    await asyncio.sleep(min(max(wait, 0.5), max(deadline - time.monotonic(), 0)))
+                try:
+                    return await send_func()
+                except RetryAfter as e:
+                    attempt += 1
+                    self.retry_after_count += 1
+                    self._chat_bucket(chat_id).block(retry_after_seconds(e))
+                    if attempt > self.max_retries:
+                        raise
+
+    def describe(self, chat_ids: List[int]) -> str:
+        """当前令牌桶状态"""
+        now = time.monotonic()
+        lines = [f"• 全局: {self.global_bucket.level():.1f}/{self.global_bucket.capacity:.0f}",
+                 f"• 排队中: {self.waiting}",
+                 f"• 限流重试: {self.retry_after_count}"]
+        for chat_id in chat_ids:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                continue
+            line = f"• {chat_id}: {bucket.level():.1f}/{bucket.capacity:.0f}"
+            if bucket.blocked_until > now:
+                line += f" (限流 {bucket.blocked_until - now:.0f}秒)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class ErrorDigest:
+    """转发失败汇总: 按 (目标, 错误类型) 聚合，同一窗口内每位管理员只收到一条汇总
+
+    突发失败先收集 gather_seconds 秒再发送，两次汇总之间至少间隔 window_seconds 秒。
+    """
+
+    MAX_LINES = 20
+
+    def __init__(self, window_seconds: float = 60.0, gather_seconds: float = 5.0):
+        self.window_seconds = window_seconds
+        self.gather_seconds = gather_seconds
+        # (target_id, error_class) -> [次数, 源频道 Counter, 最近一条错误信息, 首次时间, 最近时间]
+        self.entries: Dict[tuple, list] = {}
+        self.last_sent = 0.0
+        self.digests_sent = 0
+        self.failures_reported = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, target_id: int, error_class: str, source: str, error_msg: str):
+        """登记一次失败"""
+        now = time.time()
+        entry = self.entries.get((target_id, error_class))
+        if entry is None:
+            entry = self.entries[(target_id, error_class)] = [0, Counter(), error_msg, now, now]
+        entry[0] += 1
+        entry[1][source] += 1
+        entry[2] = error_msg
+        entry[4] = now
+
+    def delay(self) -> float:
+        """距离下一次可以发送汇总的时间"""
+        return max(self.gather_seconds, self.last_sent + self.window_seconds - time.time())
+
+    def take(self) -> Optional[str]:
+        """取出当前汇总文本并清空"""
+        if not self.entries:
+            return None
+        entries, self.entries = self.entries, {}
+        self.last_sent = time.time()
+        self.digests_sent += 1
+        total = sum(entry[0] for entry in entries.values())
+        self.failures_reported += total
+
+        ordered = sorted(entries.items(), key=lambda kv: kv[1][0], reverse=True)
+        lines = [f"❌ 转发失败汇总 (共 {total} 次，{len(entries)} 类)", ""]
+        for (target_id, error_class), (count, sources, error_msg, first, last) in ordered[:self.MAX_LINES]:
+            first_str = datetime.fromtimestamp(first).strftime('%H:%M:%S')
+            last_str = datetime.fromtimestamp(last).strftime('%H:%M:%S')
+            source_str = "、".join(name for name, _ in sources.most_common(3))
+            if len(sources) > 3:
+                source_str += f" 等 {len(sources)} 个"
+            lines.append(f"🎯 {target_id} · {error_class} × {count} ({first_str} ~ {last_str})")
+            lines.append(f"   📢 {source_str}")
+            lines.append(f"   ⚠️ {error_msg[:200]}")
+        if len(ordered) > self.MAX_LINES:
+            lines.append(f"... 另有 {len(ordered) - self.MAX_LINES} 类错误")
+        return "\n".join(lines)
+
+
+class ForwardQueue:
+    """持久化转发队列 (forward_bot.db 中的 forward_queue 表)"""
+
+    def __init__(self, db_path: str, max_attempts: int = 5, retry_base_seconds: float = 5,
+                 retry_max_seconds: float = 600):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.Lock()
+        self.event = asyncio.Event()
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.idle_poll_seconds = 5.0
+
+    def recover(self) -> int:
+        """重启后将未完成的任务恢复为待处理，旧版本标记为失败的任务移入死信表"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE forward_queue SET status = 'pending', started_at = NULL WHERE status = 'running'")
+            self.conn.execute(
+                "INSERT INTO forward_dead_letters "
+                "(payload, target_chat_id, error_class, error_message, attempts, created_at, failed_at) "
+                "SELECT payload, NULL, '', last_error, attempts, created_at, ? FROM forward_queue "
+                "WHERE status = 'failed'", (time.time(),))
+            self.conn.execute("DELETE FROM forward_queue WHERE status = 'failed'")
+            self.conn.commit()
+            return cursor.rowcount
+
+    def _put(self, payload: str, available_at: float):
+        with self.lock:
+            started = time.perf_counter()
+            self.conn.execute(
+                "INSERT INTO forward_queue (payload, status, attempts, created_at, available_at) "
+                "VALUES (?, 'pending', 0, ?, ?)",
+                (payload, time.time(), available_at))
+            self.conn.commit()
+            SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started, ('forward_queue',))
+
+    async def put(self, payload: dict, delay: float = 0):
+        """写入任务，delay 秒后可被处理"""
+        data = json.dumps(payload, ensure_ascii=False)
+        await asyncio.to_thread(self._put, data, time.time() + delay)
+        self.event.set()
+
+    def _claim(self):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, payload, attempts FROM forward_queue "
+                "WHERE status = 'pending' AND available_at <= ? ORDER BY available_at, id LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE forward_queue SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, row[0]))
+            self.conn.commit()
+            return row[0], json.loads(row[1]), row[2] + 1
+
+    async def claim(self):
+        """取出一个可处理的任务，返回 (job_id, payload, attempts) 或 None"""
+        return await asyncio.to_thread(self._claim)
+
+    def _finish(self, job_id: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM forward_queue WHERE id = ?", (job_id,))
+            self.conn.commit()
+
+    async def done(self, job_id: int):
+        """任务完成"""
+        await asyncio.to_thread(self._finish, job_id)
+
+    def _fail(self, job_id: int, attempts: int, error_class: str, error_msg: str, delay: float):
+        with self.lock:
+            if attempts >= self.max_attempts:
+                self.conn.execute(
+                    "INSERT INTO forward_dead_letters "
+                    "(payload, target_chat_id, error_class, error_message, attempts, created_at, failed_at) "
+                    "SELECT payload, NULL, ?, ?, attempts, created_at, ? FROM forward_queue WHERE id = ?",
+                    (error_class, error_msg, time.time(), job_id))
+                self.conn.execute("DELETE FROM forward_queue WHERE id = ?", (job_id,))
+            else:
+                self.conn.execute(
+                    "UPDATE forward_queue SET status = 'pending', last_error = ?, available_at = ? WHERE id = ?",
+                    (error_msg, time.time() + delay, job_id))
+            self.conn.commit()
+
+    async def fail(self, job_id: int, attempts: int, error: Exception):
+        """任务异常，按与单目标重试相同的退避策略稍后重试，次数用尽后移入死信表"""
+        delay = backoff_delay(attempts - 1, self.retry_base_seconds, self.retry_max_seconds, error)
+        await asyncio.to_thread(self._fail, job_id, attempts, type(error).__name__, str(error), delay)
+        self.event.set()
+
+    def _bury(self, payload: str, target_id: Optional[int], error_class: str, error_msg: str,
+              attempts: int, created_at: float):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO forward_dead_letters "
+                "(payload, target_chat_id, error_class, error_message, attempts, created_at, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (payload, target_id, error_class, error_msg, attempts, created_at, time.time()))
+            self.conn.commit()
+
+    async def bury(self, payload: dict, target_id: Optional[int], error: Exception, attempts: int):
+        """写入死信表，等待管理员重放"""
+        data = json.dumps(payload, ensure_ascii=False)
+        await asyncio.to_thread(self._bury, data, target_id, type(error).__name__, str(error),
+                                attempts, time.time())
+
+    def dead_letter_summary(self) -> List[tuple]:
+        """死信按 (目标, 错误类型) 分组的数量 [(target_chat_id, error_class, count)]"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT target_chat_id, error_class, COUNT(*) FROM forward_dead_letters "
+                "GROUP BY target_chat_id, error_class ORDER BY COUNT(*) DESC").fetchall()
+
+    def dead_letters_after(self, last_id: int, limit: int) -> List[int]:
+        """id 大于 last_id 的死信 id，按写入顺序"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM forward_dead_letters WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def _requeue(self, dead_id: int) -> bool:
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO forward_queue (payload, status, attempts, created_at, available_at) "
+                "SELECT payload, 'pending', 0, ?, ? FROM forward_dead_letters WHERE id = ?",
+                (time.time(), time.time(), dead_id))
+            self.conn.execute("DELETE FROM forward_dead_letters WHERE id = ?", (dead_id,))
+            self.conn.commit()
+            return cursor.rowcount > 0
+
+    async def requeue(self, dead_id: int) -> bool:
+        """将一条死信重新放回队列 (同一事务内移出死信表)"""
+        requeued = await asyncio.to_thread(self._requeue, dead_id)
+        self.event.set()
+        return requeued
+
+    def _next_available(self) -> Optional[float]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(available_at) FROM forward_queue WHERE status = 'pending'").fetchone()
+            return row[0] if row else None
+
+    async def wait_for_job(self):
+        """等待新任务写入或延迟任务到期"""
+        self.event.clear()
+        next_at = await asyncio.to_thread(self._next_available)
+        timeout = self.idle_poll_seconds
+        if next_at is not None:
+            timeout = min(timeout, max(0.0, next_at - time.time()))
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def depth(self) -> Dict[str, tuple]:
+        """各状态的任务数量及最早时间 {status: (count, oldest)}，死信记为 'dead'"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*), MIN(created_at) FROM forward_queue GROUP BY status").fetchall()
+            dead = self.conn.execute("SELECT COUNT(*), MIN(failed_at) FROM forward_dead_letters").fetchone()
+        depth = {status: (count, oldest) for status, count, oldest in rows}
+        depth['dead'] = (dead[0], dead[1])
+        return depth
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ForwardLogWriter:
+    """转发日志批量写入器: 内存缓冲，按数量或时间批量写入，单一长连接 (WAL)"""
+
+    def __init__(self, db_path: str, batch_size: int = 200, flush_interval: float = 1.0,
+                 max_pending: int = 10000):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.buffer: List[tuple] = []
+        self.flush_event = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, row: tuple):
+        """加入一条日志，缓冲区已满时丢弃并计数"""
+        if len(self.buffer) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush_event.set()
+
+    def start(self):
+        """启动后台写入协程"""
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            await self.flush()
+
+    def _write(self, rows: List[tuple]):
+        # 汇总表与明细在同一事务中更新: (日期, 类型, 目标, 是否成功) -> 条数
+        rollup = Counter(
+            (row[9][:10], row[4] or '', row[1], 1 if row[7] else 0) for row in rows
+        )
+        started = time.perf_counter()
+        self.conn.executemany('''
+            INSERT INTO forward_logs 
+            (source_chat_id, target_chat_id, original_message_id, 
+             forwarded_message_id, content_type, media_group_id, is_media_group, success, error_message, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        self.conn.executemany('''
+            INSERT INTO forward_stats_daily (day, content_type, target_chat_id, success, count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (day, content_type, target_chat_id, success)
+            DO UPDATE SET count = count + excluded.count
+        ''', [key + (count,) for key, count in rollup.items()])
+        self.conn.commit()
+        SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started, ('forward_logs',))
+
+    async def flush(self):
+        """将缓冲区写入数据库 (在线程中执行，不阻塞事件循环)"""
+        async with self.flush_lock:
+            if not self.buffer:
+                return
+            rows, self.buffer = self.buffer, []
+            try:
+                await asyncio.to_thread(self._write, rows)
+                self.written += len(rows)
+            except Exception as e:
+                self.dropped += len(rows)
+                logger.error(f"批量写入转发日志失败 ({len(rows)}条): {e}")
+
+    async def close(self):
+        """停止后台协程并写入剩余日志"""
+        self.closing = True
+        self.flush_event.set()
+        if self.task:
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+        self.conn.close()
+
+
+class RewriteCache:
+    """DeepSeek 重写结果缓存: 内存 LRU + SQLite 持久层 (过期时间与容量淘汰)
+
+    缓存键为 (规范化文本, 模型, 系统提示词, 温度) 的哈希，重写设置变更后旧结果自动失效。
+    """
+
+    def __init__(self, db_path: str, memory_size: int = 512, max_entries: int = 20000,
+                 ttl_seconds: float = 7 * 86400):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        self.memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.settings_hash: Optional[str] = None
+        self.puts_since_evict = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def settings_fingerprint(model: str, system_prompt: str, temperature: float) -> str:
+        """重写设置指纹"""
+        data = json.dumps([model, system_prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def make_key(text: str, settings_hash: str) -> str:
+        """缓存键: 规范化文本 (合并空白) + 设置指纹"""
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f"{settings_hash}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def _invalidate(self, settings_hash: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM rewrite_cache WHERE settings_hash != ?", (settings_hash,))
+            self.conn.commit()
+
+    async def ensure_settings(self, settings_hash: str):
+        """重写设置变更时清除旧设置下的缓存"""
+        if settings_hash == self.settings_hash:
+            return
+        if self.settings_hash is not None:
+            logger.info("DeepSeek 设置已变更，清除重写缓存")
+        self.settings_hash = settings_hash
+        self.memory.clear()
+        await asyncio.to_thread(self._invalidate, settings_hash)
+
+    def _get(self, key: str) -> Optional[tuple]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result, created_at FROM rewrite_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE rewrite_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+            return row
+
+    async def get(self, key: str) -> Optional[str]:
+        """查询缓存，未命中或已过期时返回 None"""
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None and now - entry[1] < self.ttl_seconds:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0]
+
+        row = await asyncio.to_thread(self._get, key)
+        if row is not None and now - row[1] < self.ttl_seconds:
+            self._remember(key, row[0], row[1])
+            self.disk_hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def _remember(self, key: str, result: str, created_at: float):
+        self.memory[key] = (result, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _put(self, key: str, result: str, created_at: float, evict: bool):
+        with self.lock:
+            started = time.perf_counter()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rewrite_cache (key, settings_hash, result, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, self.settings_hash, result, created_at, created_at))
+            if evict:
+                self.conn.execute("DELETE FROM rewrite_cache WHERE created_at < ?",
+                                  (created_at - self.ttl_seconds,))
+                self.conn.execute(
+                    "DELETE FROM rewrite_cache WHERE key IN ("
+                    "SELECT key FROM rewrite_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+            self.conn.commit()
+            SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started, ('rewrite_cache',))
+
+    async def put(self, key: str, result: str):
+        """写入缓存，每写入一定数量后执行一次过期与容量淘汰"""
+        created_at = time.time()
+        self._remember(key, result, created_at)
+        self.puts_since_evict += 1
+        evict = self.puts_since_evict >= 100
+        if evict:
+            self.puts_since_evict = 0
+        await asyncio.to_thread(self._put, key, result, created_at, evict)
+
+    def describe(self) -> str:
+        """缓存命中情况"""
+        total = self.memory_hits + self.disk_hits + self.misses
+        hit_rate = (self.memory_hits + self.disk_hits) / total * 100 if total else 0.0
+        return (f"• 命中率: {hit_rate:.1f}% (内存 {self.memory_hits}，磁盘 {self.disk_hits}，未命中 {self.misses})\n"
+                f"• 内存条目: {len(self.memory)}/{self.memory_size}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class BloomFilter:
+    """布隆过滤器: 固定内存，可能把未出现过的键误判为已存在，但不会漏判"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class DuplicateFilter:
+    """跨源频道去重
+
+    媒体 (含媒体组) 以 file_unique_id 生成指纹，纯文本以规范化文本的 64 位 SimHash 生成指纹。
+    指纹连同源频道一起记录，只有其他源频道转发过的内容才算重复，同一频道的重发照常转发。
+    时间窗口内的指纹保存在精确集合中，文本可按海明距离做近似匹配；因容量上限被淘汰的指纹
+    仍由两代轮换的布隆过滤器记住。
+
+    检查通过时只预留精确指纹 (挡住同时到达的其他源)，至少一个目标发送成功后才正式记住并写入 SQLite，
+    发送最终失败时释放预留。
+    """
+
+    # SimHash 按 16 位分为 4 段，海明距离不超过 3 时至少有一段完全相同
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, db_path: str, window_seconds: float = 86400, max_entries: int = 20000,
+                 max_distance: int = 3, min_text_length: int = 10):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.lock = threading.Lock()
+        # 内存中的指纹在线程中检查、在事件循环中确认，需要单独加锁
+        self.state_lock = threading.Lock()
+        self.window_seconds = window_seconds
+        self.max_entries = max(1, max_entries)
+        self.max_distance = min(max(0, max_distance), self.BANDS - 1)
+        self.min_text_length = min_text_length
+        # 指纹 -> (首次出现时间, 源频道)，按时间先后排列
+        self.recent: "OrderedDict[str, tuple]" = OrderedDict()
+        # SimHash 分段 -> {SimHash: 源频道}
+        self.bands: Dict[tuple, Dict[int, int]] = defaultdict(dict)
+        # 每半个窗口轮换一次，指纹在布隆过滤器中保留半个到一个窗口 (同时记录 指纹 与 指纹@源频道)
+        self.blooms = [BloomFilter(self.max_entries * 2), BloomFilter(self.max_entries * 2)]
+        self.rotated_at = time.time()
+        # 尚未发送成功的消息 (源频道, 消息ID) -> (类型, 指纹, 时间)，以及预留的指纹 -> 源频道
+        self.pending: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.reserved: Dict[str, int] = {}
+        self.stores_since_prune = 0
+        self.suppressed = Counter()
+
+    @staticmethod
+    def simhash(text: str) -> int:
+        """按 3 字符片段计算 64 位 SimHash"""
+        shingles = Counter(text[i:i + 3] for i in range(max(1, len(text) - 2)))
+        ones = [0] * 64
+        total = 0
+        for shingle, weight in shingles.items():
+            h = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            total += weight
+            for bit in range(64):
+                if h >> bit & 1:
+                    ones[bit] += weight
+        value = 0
+        for bit in range(64):
+            if ones[bit] * 2 > total:
+                value |= 1 << bit
+        return value
+
+    def fingerprint(self, items: List[MediaItem]) -> Optional[tuple]:
+        """返回 (类型, 指纹, SimHash)，无法生成指纹时返回 None"""
+        file_ids = sorted(item.file_unique_id for item in items if item.file_unique_id)
+        if file_ids:
+            digest = hashlib.sha256('\0'.join(file_ids).encode('utf-8')).hexdigest()[:32]
+            return 'media', f"m:{digest}", None
+
+        text = ' '.join(item.text for item in items if item.text)
+        normalized = re.sub(r'[\W_]+', '', text.lower())[:4000]
+        if len(normalized) < self.min_text_length:
+            return None
+        value = self.simhash(normalized)
+        return 'text', f"t:{value:016x}", value
+
+    def _band_keys(self, value: int):
+        mask = (1 << self.BAND_BITS) - 1
+        return [(i, value >> (i * self.BAND_BITS) & mask) for i in range(self.BANDS)]
+
+    def _remember(self, key: str, seen_at: float, source: int):
+        self.recent[key] = (seen_at, source)
+        self.recent.move_to_end(key)
+        self.blooms[0].add(key)
+        self.blooms[0].add(f"{key}@{source}")
+        if key.startswith('t:'):
+            value = int(key[2:], 16)
+            for band in self._band_keys(value):
+                self.bands[band][value] = source
+
+    def _forget(self, key: str):
+        self.recent.pop(key, None)
+        if key.startswith('t:'):
+            value = int(key[2:], 16)
+            for band in self._band_keys(value):
+                values = self.bands.get(band)
+                if values is not None:
+                    values.pop(value, None)
+                    if not values:
+                        del self.bands[band]
+
+    def _expire(self, now: float):
+        """淘汰窗口外或超出容量的指纹与预留，并按时轮换布隆过滤器"""
+        cutoff = now - self.window_seconds
+        while self.recent:
+            key, (seen_at, _) = next(iter(self.recent.items()))
+            if seen_at >= cutoff and len(self.recent) <= self.max_entries:
+                break
+            self._forget(key)
+        while self.pending:
+            message, (_, key, seen_at) = next(iter(self.pending.items()))
+            if seen_at >= cutoff and len(self.pending) <= self.max_entries:
+                break
+            self._release(message)
+        if now - self.rotated_at >= self.window_seconds / 2:
+            self.blooms = [BloomFilter(self.max_entries * 2), self.blooms[0]]
+            self.rotated_at = now
+
+    def _seen_elsewhere(self, key: str, source: int) -> bool:
+        """精确指纹是否由其他源频道记录或预留过"""
+        entry = self.recent.get(key)
+        if entry is not None:
+            return entry[1] != source
+        if key in self.reserved:
+            return self.reserved[key] != source
+        # 布隆过滤器中有指纹、却没有本频道的记录，说明来自其他源频道
+        return any(key in bloom for bloom in self.blooms) and \
+            not any(f"{key}@{source}" in bloom for bloom in self.blooms)
+
+    def _is_near(self, value: int, source: int) -> bool:
+        candidates = {}
+        for band in self._band_keys(value):
+            candidates.update(self.bands.get(band, {}))
+        return any(other_source != source and bin(value ^ other).count('1') <= self.max_distance
+                   for other, other_source in candidates.items())
+
+    def _check(self, items: List[MediaItem]) -> Optional[tuple]:
+        """在线程中执行: 计算指纹并检查，未重复时预留精确指纹"""
+        fingerprint = self.fingerprint(items)
+        if fingerprint is None:
+            return None
+        kind, key, value = fingerprint
+        source = items[0].chat_id
+        now = time.time()
+        with self.state_lock:
+            self._expire(now)
+            duplicate = self._seen_elsewhere(key, source)
+            if not duplicate and value is not None:
+                duplicate = self._is_near(value, source)
+            if duplicate:
+                self.suppressed[kind] += 1
+            else:
+                self.pending[(source, items[0].message_id)] = (kind, key, now)
+                self.reserved[key] = source
+        return kind, now, duplicate
+
+    def _release(self, message: tuple) -> Optional[tuple]:
+        entry = self.pending.pop(message, None)
+        if entry is not None and self.reserved.get(entry[1]) == message[0]:
+            del self.reserved[entry[1]]
+        return entry
+
+    def _store(self, key: str, seen_at: float, source: int, prune: bool):
+        with self.lock:
+            started = time.perf_counter()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dedup_fingerprints (fingerprint, seen_at, source_chat_id) VALUES (?, ?, ?)",
+                (key, seen_at, source))
+            if prune:
+                self.conn.execute("DELETE FROM dedup_fingerprints WHERE seen_at < ?",
+                                  (seen_at - self.window_seconds,))
+            self.conn.commit()
+            SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started, ('dedup_fingerprints',))
+
+    def _count(self, kind: str, seen_at: float):
+        day = datetime.fromtimestamp(seen_at, timezone.utc).strftime('%Y-%m-%d')
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO dedup_stats_daily (day, kind, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(day, kind) DO UPDATE SET count = count + 1", (day, kind))
+            self.conn.commit()
+
+    async def is_duplicate(self, items: List[MediaItem]) -> Optional[str]:
+        """其他源频道在窗口内转发过的消息返回类型 ('media' / 'text')；否则预留指纹并返回 None"""
+        result = await asyncio.to_thread(self._check, items)
+        if result is None:
+            return None
+        kind, seen_at, duplicate = result
+        if not duplicate:
+            return None
+        DUPLICATES_SUPPRESSED.inc(1, (kind,))
+        await asyncio.to_thread(self._count, kind, seen_at)
+        return kind
+
+    async def confirm(self, items: List[MediaItem]):
+        """至少一个目标发送成功后调用: 正式记住指纹并写入数据库"""
+        source = items[0].chat_id
+        with self.state_lock:
+            entry = self._release((source, items[0].message_id))
+            if entry is None:
+                return
+            _, key, seen_at = entry
+            self._remember(key, seen_at, source)
+        self.stores_since_prune += 1
+        prune = self.stores_since_prune >= 100
+        if prune:
+            self.stores_since_prune = 0
+        await asyncio.to_thread(self._store, key, seen_at, source, prune)
+
+    def release(self, items: List[MediaItem]):
+        """某个目标最终失败时调用: 释放预留，之后其他源频道的同一内容可以转发
+
+        消息本身仍保留在 pending 中，其他目标之后发送成功时照常确认。
+        """
+        with self.state_lock:
+            entry = self.pending.get((items[0].chat_id, items[0].message_id))
+            if entry is not None and self.reserved.get(entry[1]) == items[0].chat_id:
+                del self.reserved[entry[1]]
+
+    def load(self) -> int:
+        """启动时从数据库恢复窗口内的指纹 (没有记录源频道的旧指纹不再恢复)"""
+        cutoff = time.time() - self.window_seconds
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT fingerprint, seen_at, source_chat_id FROM dedup_fingerprints "
+                "WHERE seen_at >= ? AND source_chat_id IS NOT NULL "
+                "ORDER BY seen_at DESC LIMIT ?", (cutoff, self.max_entries)).fetchall()
+        with self.state_lock:
+            for key, seen_at, source in reversed(rows):
+                self._remember(key, seen_at, source)
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CircuitBreaker:
+    """熔断器: 连续失败或响应过慢达到阈值后暂停调用，冷却后放行一次试探请求"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, slow_seconds: float = 10.0, reset_seconds: float = 60.0):
+        self.configure(failure_threshold, slow_seconds, reset_seconds)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def configure(self, failure_threshold: int, slow_seconds: float, reset_seconds: float):
+        """更新阈值，保留当前状态 (修改配置不会重置已打开的熔断器)"""
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_seconds = slow_seconds
+        self.reset_seconds = reset_seconds
+
+    def allow(self) -> bool:
+        """是否允许本次调用"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self, elapsed: float):
+        """记录成功调用，过慢的响应按失败计"""
+        if elapsed > self.slow_seconds:
+            self.record_failure()
+            return
+        self.failures = 0
+        self.probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info("✅ DeepSeek 已恢复，熔断器关闭")
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        """记录失败调用"""
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"⚠️ DeepSeek 连续失败 {self.failures} 次，熔断 {self.reset_seconds:.0f} 秒")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """试探请求被取消、没有结果时放行下一次试探"""
+        self.probe_in_flight = False
 
 
 class DeepSeekRewriter:
     """DeepSeek AI 文本重写器"""
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, cache: Optional[RewriteCache] = None):
         self.config = config
         self.client = None
+        self.cache = cache
+        settings = config.get('deepseek_settings', {})
+        # 同时进行中的重写请求上限
+        self.semaphore = asyncio.Semaphore(max(1, int(settings.get('max_concurrent_requests', 4))))
+        self.in_flight = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.skipped = 0
+        self.breaker = CircuitBreaker()
         self._init_client()
 
     def _init_client(self):
         """初始化 OpenAI 客户端"""
         settings = self.config.get('deepseek_settings', {})
+        self.breaker.configure(
+            failure_threshold=settings.get('breaker_failure_threshold', 3),
+            slow_seconds=settings.get('breaker_slow_seconds', 10),
+            reset_seconds=settings.get('breaker_reset_seconds', 60),
+        )
         api_key = settings.get('api_key', '')
         base_url = settings.get('base_url', 'https://api.deepseek.com')
 
@@ -112,8 +1576,8 @@ class DeepSeekRewriter:
         self.config = config
         self._init_client()
 
-    async def rewrite_text(self, text: str) -> str:
-        """使用 DeepSeek 重写文本"""
+    async def rewrite_text(self, text: str, force: bool = False) -> str:
+        """使用 DeepSeek 重写文本，force 为 True 时跳过缓存与熔断 (用于测试)"""
         settings = self.config.get('deepseek_settings', {})
 
         if not settings.get('enabled', False):
@@ -126,56 +1590,371 @@ class DeepSeekRewriter:
         if not text or not text.strip():
             return text
 
-        try:
-            system_prompt = settings.get('system_prompt',
-                                         "你是一个专业的文本重写助手。请将用户提供的文本进行重写，保持原意但使用不同的表达方式。只返回重写后的文本，不要添加任何解释。")
-            model = settings.get('model', 'deepseek-chat')
-            max_tokens = settings.get('max_tokens', 2000)
-            temperature = settings.get('temperature', 0.7)
+        system_prompt = settings.get('system_prompt',
+                                     "你是一个专业的文本重写助手。请将用户提供的文本进行重写，保持原意但使用不同的表达方式。只返回重写后的文本，不要添加任何解释。")
+        model = settings.get('model', 'deepseek-chat')
+        max_tokens = settings.get('max_tokens', 2000)
+        temperature = settings.get('temperature', 0.7)
 
+        cache_key = None
+        if not force and self.cache and settings.get('cache_enabled', True):
+            try:
+                await self.cache.ensure_settings(RewriteCache.settings_fingerprint(model, system_prompt, temperature))
+                cache_key = RewriteCache.make_key(text, self.cache.settings_hash)
+                cached = await self.cache.get(cache_key)
+                if cached is not None:
+                    logger.info("✅ DeepSeek 重写命中缓存")
+                    return cached
+            except Exception as e:
+                cache_key = None
+                logger.error(f"读取重写缓存失败: {e}")
+
+        # 熔断期间直接返回原文 (已应用伪原创规则)
+        breaker = self.breaker
+        if not force and not breaker.allow():
+            self.skipped += 1
+            logger.info("DeepSeek 熔断中，跳过重写")
+            return text
+        # 半开状态下本次调用即试探请求
+        probe = not force and breaker.state == breaker.HALF_OPEN
+
+        async def request():
+            async with self.semaphore:
+                self.in_flight += 1
+                try:
+                    return await self.client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": text}
+                        ],
+                        max_tokens=max_tokens,
+                        temperature=temperature
+                    )
+                finally:
+                    self.in_flight -= 1
+
+        started = time.monotonic()
+        try:
             logger.info(f"开始 DeepSeek 重写...")
 
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": text}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
+            # 排队与请求的总耗时不超过 request_timeout
+            response = await asyncio.wait_for(request(), settings.get('request_timeout', 15))
 
             rewritten_text = response.choices[0].message.content.strip()
+            breaker.record_success(time.monotonic() - started)
+            DEEPSEEK_SECONDS.observe(time.monotonic() - started, ('ok',))
             logger.info(f"✅ DeepSeek 重写成功")
-            return rewritten_text
-
+        except asyncio.CancelledError:
+            # 被取消时既不算成功也不算失败，但要释放试探名额，否则熔断器一直停在半开状态
+            if probe:
+                breaker.release_probe()
+            raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            breaker.record_failure()
+            DEEPSEEK_SECONDS.observe(time.monotonic() - started, ('timeout',))
+            logger.error(f"❌ DeepSeek 重写超时 ({time.monotonic() - started:.1f}秒)")
+            return text
         except Exception as e:
+            self.failures += 1
+            breaker.record_failure()
+            DEEPSEEK_SECONDS.observe(time.monotonic() - started, ('error',))
             logger.error(f"❌ DeepSeek 重写失败: {e}")
             return text
 
+        if cache_key and rewritten_text:
+            try:
+                await self.cache.put(cache_key, rewritten_text)
+            except Exception as e:
+                logger.error(f"写入重写缓存失败: {e}")
+        return rewritten_text
+
+
+class ConfigWriter:
+    """配置文件写入器
+
+    短时间内的多次修改合并为一次写入；写入在线程中进行，先写临时文件并 fsync，
+    再原子替换原文件，替换前保留最近 backups 份备份。没有运行中的事件循环时直接同步写入。
+    """
+
+    def __init__(self, path: str, debounce_seconds: float = 1.0, backups: int = 3, indent: int = 2):
+        self.path = path
+        self.debounce_seconds = debounce_seconds
+        self.backups = backups
+        self.indent = indent
+        self.pending: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+        self.writes = 0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+
+    def save(self, config: dict):
+        """登记一次修改，稍后写入"""
+        self.pending = config
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.debounce_seconds)
+        await self.flush()
+
+    async def flush(self):
+        """立即写入尚未保存的修改"""
+        async with self.lock:
+            while self.pending is not None:
+                # 序列化在事件循环中完成，避免与配置修改并发
+                data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+                self.pending = None
+                await asyncio.to_thread(self._write, data)
+
+    async def close(self):
+        """取消等待中的延迟写入，立即写入剩余修改"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush()
+
+    def flush_sync(self):
+        """同步写入，用于启动阶段"""
+        if self.pending is not None:
+            data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+            self.pending = None
+            self._write(data)
+
+    def _write(self, data: str):
+        start = time.perf_counter()
+        try:
+            self._rotate_backups()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._fsync_directory(directory)
+        except Exception as e:
+            logger.error(f"保存配置文件失败: {e}")
+            return
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.writes += 1
+        self.last_ms = elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        logger.debug(f"配置文件已保存，耗时 {elapsed_ms:.1f}ms")
+
+    def _rotate_backups(self):
+        """config.json.1 为最近一次的备份，编号越大越旧"""
+        if self.backups <= 0 or not os.path.exists(self.path):
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        shutil.copy2(self.path, f"{self.path}.1")
+
+    @staticmethod
+    def _fsync_directory(directory: str):
+        """确保替换操作落盘 (Windows 不支持打开目录，忽略)"""
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def describe(self) -> str:
+        """写入次数与耗时"""
+        return f"• 配置写入: {self.writes} 次，最近 {self.last_ms:.1f}ms，最长 {self.max_ms:.1f}ms"
+
+
+class ConfigSnapshot:
+    """转发热路径使用的只读配置快照
+
+    由 config 编译而来: 频道与管理员为 frozenset，关键词自动机与伪原创引擎已编译，
+    常用开关预先取出。配置修改后整体替换，处理中的消息继续使用旧快照。
+    """
+
+    __slots__ = ('admins', 'source_channels', 'target_channels', 'target_set', 'filter_content_types',
+                 'keyword_filter', 'keyword_matcher', 'paraphrase_rules', 'paraphrase_engine',
+                 'deepseek_enabled', 'add_source_info', 'preserve_sender', 'delay_seconds',
+                 'concurrent_forward', 'dedup_enabled', 'notify_admin_on_error', 'needs_processing')
+
+    def __init__(self, config: dict, previous: Optional["ConfigSnapshot"] = None):
+        forward_settings = config['forward_settings']
+        keyword_filter = tuple(forward_settings.get('keyword_filter', []))
+        paraphrase_rules = tuple(config.get('paraphrase_rules', {}).items())
+
+        # 关键词与规则未变化时沿用已编译的匹配器
+        if previous is not None and previous.keyword_filter == keyword_filter:
+            keyword_matcher = previous.keyword_matcher
+        else:
+            keyword_matcher = KeywordAutomaton(keyword_filter)
+        if previous is not None and previous.paraphrase_rules == paraphrase_rules:
+            paraphrase_engine = previous.paraphrase_engine
+        else:
+            paraphrase_engine = ParaphraseEngine(dict(paraphrase_rules))
+
+        values = {
+            'admins': frozenset(config.get('admins', [])),
+            'source_channels': frozenset(config.get('source_channels', [])),
+            'target_channels': tuple(config.get('target_channels', [])),
+            'target_set': frozenset(config.get('target_channels', [])),
+            'filter_content_types': frozenset(forward_settings.get('filter_content_types', [])),
+            'keyword_filter': keyword_filter,
+            'keyword_matcher': keyword_matcher,
+            'paraphrase_rules': paraphrase_rules,
+            'paraphrase_engine': paraphrase_engine,
+            'deepseek_enabled': bool(config.get('deepseek_settings', {}).get('enabled', False)),
+            'add_source_info': bool(forward_settings.get('add_source_info', True)),
+            'preserve_sender': bool(forward_settings.get('preserve_sender', True)),
+            'delay_seconds': forward_settings.get('delay_seconds', 0),
+            'concurrent_forward': bool(forward_settings.get('concurrent_forward', True)),
+            'dedup_enabled': bool(forward_settings.get('dedup_enabled', False)),
+            'notify_admin_on_error': bool(
+                config.get('notification_settings', {}).get('notify_admin_on_error', True)),
+        }
+        values['needs_processing'] = (values['deepseek_enabled'] or bool(paraphrase_rules)
+                                      or values['add_source_info'])
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("配置快照不可修改，请修改 config 后重新编译")
+
 
 class TelegramForwardBot:
-    def __init__(self, token: str):
+    def __init__(self, token: str, base_url: Optional[str] = None):
         self.token = token
-        self.application = Application.builder().token(token).build()
         self.db_path = "forward_bot.db"
         self.config_file = "bot_config.json"
+        self.config_writer = ConfigWriter(self.config_file)
 
-        self.media_group_handler = MediaGroupHandler()
         self.init_database()
         self.config = self.load_config()
-        self.deepseek_rewriter = DeepSeekRewriter(self.config)
-
-        self.stats = {
-            'messages_received': 0,
-            'messages_forwarded': 0,
-            'failed_forwards': 0,
-            'media_groups_forwarded': 0,
-            'start_time': datetime.now()
-        }
+        self.application = self.build_application(base_url)
+        forward_settings = self.config['forward_settings']
+        self.media_group_handler = MediaGroupHandler(
+            max_open_groups=forward_settings.get('media_group_max_open', 200),
+            max_buffered_items=forward_settings.get('media_group_max_items', 1000),
+            stale_seconds=forward_settings.get('media_group_stale_seconds', 30),
+        )
+        deepseek_settings = self.config['deepseek_settings']
+        self.rewrite_cache = RewriteCache(
+            self.db_path,
+            max_entries=deepseek_settings.get('cache_max_entries', 20000),
+            ttl_seconds=deepseek_settings.get('cache_ttl_hours', 168) * 3600,
+        )
+        self.deepseek_rewriter = DeepSeekRewriter(self.config, self.rewrite_cache)
+        # 跨源频道重复消息过滤
+        self.duplicate_filter = DuplicateFilter(
+            self.db_path,
+            window_seconds=forward_settings.get('dedup_window_hours', 24) * 3600,
+            max_entries=forward_settings.get('dedup_max_entries', 20000),
+            max_distance=forward_settings.get('dedup_max_distance', 3),
+        )
+        self.snapshot = ConfigSnapshot(self.config)
+        # 发送限速与并发控制
+        self.send_scheduler = SendScheduler(self.config['forward_settings'])
+        # 持久化转发队列及处理协程
+        self.forward_queue = ForwardQueue(self.db_path,
+                                          int(forward_settings.get('retry_max_attempts', 5)),
+                                          forward_settings.get('retry_base_seconds', 5),
+                                          forward_settings.get('retry_max_seconds', 600))
+        self.queue_workers: List[asyncio.Task] = []
+        # 死信重放任务 (/replay)
+        self.replay_task: Optional[asyncio.Task] = None
+        self.replayed = 0
+        # 转发失败按窗口汇总后通知管理员
+        self.error_digest = ErrorDigest(
+            self.config['notification_settings'].get('error_digest_seconds', 60))
+        # 转发日志批量写入
+        self.log_writer = ForwardLogWriter(self.db_path)
+        # 每条消息的处理结果缓存 {(chat_id, message_id): Task}，供所有目标频道复用
+        self._caption_cache: "OrderedDict[tuple, asyncio.Task]" = OrderedDict()
+        self._caption_cache_size = 256
+
+        self.start_time = datetime.now()
+        # 指标导出服务 (metrics.enabled 时在 post_init 中启动)
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        self.register_metrics()
 
         self.register_handlers()
 
+    def build_application(self, base_url: Optional[str] = None) -> Application:
+        """创建 Application，base_url 可指向自建或离线测试用的 Bot API"""
+        builder = Application.builder().token(self.token)
+        if base_url:
+            builder = builder.base_url(base_url)
+        concurrent_updates = int(self.config['forward_settings'].get('concurrent_updates', 1))
+        return (
+            builder
+            .concurrent_updates(max(1, concurrent_updates))
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
+
+    def register_metrics(self):
+        """注册从各组件读取的瞬时指标"""
+        media_groups = self.media_group_handler
+        METRICS.gauge('media_groups_open', '等待收齐的媒体组数量', lambda: len(media_groups.media_groups))
+        METRICS.gauge('media_group_buffered_items', '媒体组缓冲中的消息数', lambda: media_groups.buffered_items)
+        METRICS.gauge('media_groups_capped_total', '因缓冲区已满被提前发送的媒体组数',
+                      lambda: media_groups.capped_groups, kind='counter')
+        METRICS.gauge('media_groups_stale_total', '因滞留过久被提前发送的媒体组数',
+                      lambda: media_groups.stale_groups, kind='counter')
+        METRICS.gauge('deepseek_in_flight', '进行中的 DeepSeek 请求数', lambda: self.deepseek_rewriter.in_flight)
+        METRICS.gauge('send_waiting', '等待令牌的发送数', lambda: self.send_scheduler.waiting)
+        METRICS.gauge('retry_after_total', '收到 RetryAfter 的次数',
+                      lambda: self.send_scheduler.retry_after_count, kind='counter')
+        METRICS.gauge('forward_log_buffered', '等待写入的转发日志条数', lambda: len(self.log_writer.buffer))
+        METRICS.gauge('forward_log_dropped_total', '因缓冲区已满丢弃的转发日志条数',
+                      lambda: self.log_writer.dropped, kind='counter')
+        cache = self.rewrite_cache
+        METRICS.gauge('rewrite_cache_lookups_total', '重写缓存查询次数', lambda: {
+            ('memory',): cache.memory_hits, ('disk',): cache.disk_hits, ('miss',): cache.misses,
+        }, labelnames=('result',), kind='counter')
+        queue_depth = METRICS.gauge('queue_depth', '转发队列中的任务数', labelnames=('status',))
+
+        async def collect_queue_depth():
+            depth = await asyncio.to_thread(self.forward_queue.depth)
+            for status in ('pending', 'running', 'dead'):
+                queue_depth.set(depth.get(status, (0, None))[0], (status,))
+
+        METRICS.add_collector('queue_depth', collect_queue_depth)
+
+    def webhook_options(self) -> dict:
+        """Webhook 启动参数"""
+        webhook = self.config.get('webhook', {})
+        # 未配置密钥时每次启动随机生成，setWebhook 时一并提交给 Telegram
+        secret_token = webhook.get('secret_token') or secrets.token_urlsafe(32)
+        return {
+            'listen': webhook.get('listen', '127.0.0.1'),
+            'port': int(webhook.get('port', 8443)),
+            'url_path': (webhook.get('url_path') or '').strip('/'),
+            'webhook_url': webhook.get('webhook_url') or None,
+            'secret_token': secret_token,
+            'max_connections': int(webhook.get('max_connections', 40)),
+            'allowed_updates': ALLOWED_UPDATES,
+        }
+
     def init_database(self):
         """初始化数据库"""
         conn = sqlite3.connect(self.db_path)
@@ -232,6 +2011,92 @@ class TelegramForwardBot:
             )
         ''')
 
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forward_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                created_at REAL,
+                available_at REAL,
+                started_at REAL,
+                last_error TEXT
+            )
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_forward_queue_status ON forward_queue (status, available_at)')
+
+        # 重试用尽或永久失败的发送，target_chat_id 为空表示整个任务失败
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forward_dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                target_chat_id INTEGER,
+                error_class TEXT,
+                error_message TEXT,
+                attempts INTEGER,
+                created_at REAL,
+                failed_at REAL
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rewrite_cache (
+                key TEXT PRIMARY KEY,
+                settings_hash TEXT,
+                result TEXT,
+                created_at REAL,
+                last_used REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_rewrite_cache_last_used ON rewrite_cache (last_used)')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_fingerprints (
+                fingerprint TEXT PRIMARY KEY,
+                seen_at REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_dedup_fingerprints_seen ON dedup_fingerprints (seen_at)')
+        cursor.execute("PRAGMA table_info(dedup_fingerprints)")
+        if 'source_chat_id' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE dedup_fingerprints ADD COLUMN source_chat_id INTEGER')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dedup_stats_daily (
+                day TEXT,
+                kind TEXT,
+                count INTEGER,
+                PRIMARY KEY (day, kind)
+            )
+        ''')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_forward_logs_timestamp ON forward_logs (timestamp)')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_forward_logs_target ON forward_logs (target_chat_id, timestamp)')
+
+        # 按天汇总的统计表，随日志写入增量更新
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'forward_stats_daily'")
+        rollup_exists = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS forward_stats_daily (
+                day TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                target_chat_id INTEGER NOT NULL,
+                success INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, content_type, target_chat_id, success)
+            )
+        ''')
+        if not rollup_exists:
+            # 首次创建时从历史日志回填
+            cursor.execute('''
+                INSERT INTO forward_stats_daily (day, content_type, target_chat_id, success, count)
+                SELECT DATE(timestamp), COALESCE(content_type, ''), COALESCE(target_chat_id, 0),
+                       CASE WHEN success THEN 1 ELSE 0 END, COUNT(*)
+                FROM forward_logs
+                GROUP BY 1, 2, 3, 4
+            ''')
+
         conn.commit()
         conn.close()
 
@@ -250,10 +2115,45 @@ class TelegramForwardBot:
                 "delay_seconds": 0,
                 "batch_forward": False,
                 "max_forwards_per_minute": 60,
-                "media_group_timeout": 3
+                "media_group_timeout": 3,
+                "media_group_min_wait": 0.3,
+                "media_group_max_open": 200,
+                "media_group_max_items": 1000,
+                "media_group_stale_seconds": 30,
+                "concurrent_forward": True,
+                "max_concurrent_sends": 10,
+                "per_chat_per_minute": 20,
+                "per_chat_burst": 3,
+                "max_retry_after_retries": 3,
+                "low_priority_max_wait_seconds": 30,
+                "queue_workers": 4,
+                "concurrent_updates": 1,
+                "dedup_enabled": False,
+                "dedup_window_hours": 24,
+                "dedup_max_entries": 20000,
+                "dedup_max_distance": 3,
+                "retry_max_attempts": 5,
+                "retry_base_seconds": 5,
+                "retry_max_seconds": 600,
+                "replay_per_minute": 30
+            },
+            "webhook": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 8443,
+                "url_path": "",
+                "webhook_url": "",
+                "secret_token": "",
+                "max_connections": 40
+            },
+            "metrics": {
+                "enabled": False,
+                "listen": "127.0.0.1",
+                "port": 9108
             },
             "notification_settings": {
                 "notify_admin_on_error": True,
+                "error_digest_seconds": 60,
                 "daily_report": True,
                 "report_channel": None
             },
@@ -265,7 +2165,15 @@ class TelegramForwardBot:
                 "model": "deepseek-chat",
                 "system_prompt": "你是一个专业的文本重写助手。请将用户提供的文本进行重写，保持原意但使用不同的表达方式。保持原文的语言。只返回重写后的文本，不要添加任何解释。",
                 "max_tokens": 2000,
-                "temperature": 0.7
+                "temperature": 0.7,
+                "cache_enabled": True,
+                "cache_ttl_hours": 168,
+                "cache_max_entries": 20000,
+                "request_timeout": 15,
+                "max_concurrent_requests": 4,
+                "breaker_failure_threshold": 3,
+                "breaker_slow_seconds": 10,
+                "breaker_reset_seconds": 60
             }
         }
 
@@ -288,16 +2196,18 @@ class TelegramForwardBot:
             self.save_config(default_config)
             return default_config
 
+    def apply_config(self):
+        """保存配置并重新编译快照，新快照整体替换旧快照"""
+        self.save_config()
+        self.snapshot = ConfigSnapshot(self.config, self.snapshot)
+        # 已缓存的文案按旧配置生成，重放或重试时需要重新处理
+        self._caption_cache.clear()
+
     def save_config(self, config: dict = None):
-        """保存配置文件"""
+        """保存配置文件 (合并短时间内的多次修改，后台写入)"""
         if config is None:
             config = self.config
-
-        try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存配置文件失败: {e}")
+        self.config_writer.save(config)
 
     def register_handlers(self):
         """注册消息处理器"""
@@ -310,6 +2220,7 @@ class TelegramForwardBot:
 
         # 管理命令
         self.application.add_handler(CommandHandler("admin", self.admin_panel))
+        self.application.add_handler(CommandHandler("replay", self.replay_command))
 
         # 回调查询处理器
         self.application.add_handler(CallbackQueryHandler(self.button_callback))
@@ -322,7 +2233,7 @@ class TelegramForwardBot:
 
     async def is_admin(self, user_id: int) -> bool:
         """检查用户是否为管理员"""
-        return user_id in self.config.get("admins", [])
+        return user_id in self.snapshot.admins
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """开始命令"""
@@ -360,10 +2271,11 @@ class TelegramForwardBot:
 • `/help` \\- 显示此帮助信息
 • `/getid` \\- 获取用户/群组/频道ID
 • `/status` \\- 查看机器人运行状态
-• `/stats` \\- 查看详细统计信息
+• `/stats [开始日期] [结束日期]` \\- 查看详细统计信息
 
 ⚙️ *管理命令 \\(仅管理员\\):*
 • `/admin` \\- 打开管理面板
+• `/replay [数量|all|stop]` \\- 查看或重放发送失败的消息
 
 💡 *使用提示:*
 1\\. 将机器人添加到源频道和目标频道
@@ -428,7 +2340,7 @@ class TelegramForwardBot:
         """状态命令"""
         user_id = update.effective_user.id
 
-        uptime = datetime.now() - self.stats['start_time']
+        uptime = datetime.now() - self.start_time
         uptime_str = str(uptime).split('.')[0]
 
         deepseek_status = "✅ 已开启" if self.config.get('deepseek_settings', {}).get('enabled', False) else "❌ 已关闭"
@@ -439,10 +2351,11 @@ class TelegramForwardBot:
         status_text = f"""📊 *机器人状态*
 
 🕐 *运行时间:* {escape_markdown_v2(uptime_str)}
-📥 *接收消息:* {self.stats['messages_received']}
-📤 *转发成功:* {self.stats['messages_forwarded']}
-🖼️ *媒体组转发:* {self.stats['media_groups_forwarded']}
-❌ *转发失败:* {self.stats['failed_forwards']}
+📥 *接收消息:* {MESSAGES_RECEIVED.value():.0f}
+📤 *转发成功:* {MESSAGES_FORWARDED.value():.0f}
+🖼️ *媒体组转发:* {MEDIA_GROUPS_FORWARDED.value():.0f}
+❌ *转发失败:* {FORWARD_FAILURES.value():.0f}
+⏱️ *转发耗时:* {escape_markdown_v2(self.describe_latency())}
 
 📢 *源频道数量:* {len(self.config['source_channels'])}
 🎯 *目标频道数量:* {len(self.config['target_channels'])}
@@ -452,11 +2365,61 @@ class TelegramForwardBot:
 • 转发延迟: {self.config['forward_settings']['delay_seconds']}秒
 • 显示来源: {'✅' if self.config['forward_settings']['add_source_info'] else '❌'}
 • AI重写: {deepseek_status}
+• 每分钟转发上限: {self.config['forward_settings'].get('max_forwards_per_minute', 60)}
+
+🪣 *令牌桶:*
+{escape_markdown_v2(self.send_scheduler.describe(self.config['target_channels']))}
 
 👤 *您的管理员状态:* {admin_status}"""
 
+        if is_admin:
+            status_text += "\n\n📦 *转发队列:*\n" + escape_markdown_v2(await self.describe_queue())
+            status_text += "\n\n🧠 *AI重写:*\n" + escape_markdown_v2(self.describe_rewrite())
+
         await update.message.reply_text(status_text, parse_mode=ParseMode.MARKDOWN_V2)
 
+    def describe_latency(self) -> str:
+        """单个目标发送耗时的 P50 / P99 (按分桶估算)"""
+        p50 = FORWARD_SECONDS.quantile(0.5)
+        if p50 is None:
+            return "暂无数据"
+        return f"P50 {p50:.2f}秒，P99 {FORWARD_SECONDS.quantile(0.99):.2f}秒"
+
+    async def describe_queue(self) -> str:
+        """转发队列深度与等待时间"""
+        depth = await asyncio.to_thread(self.forward_queue.depth)
+        now = time.time()
+        names = {'pending': '待处理', 'running': '处理中', 'dead': '死信'}
+        lines = [f"• 处理协程: {len(self.queue_workers)}", self.media_group_handler.describe()]
+        for status, name in names.items():
+            count, oldest = depth.get(status, (0, None))
+            line = f"• {name}: {count}"
+            if count and oldest:
+                line += f" (最早 {now - oldest:.0f}秒前)"
+            lines.append(line)
+        if self.replay_task and not self.replay_task.done():
+            lines.append(f"• 死信重放中: 已重放 {self.replayed}")
+        writer = self.log_writer
+        lines.append(f"• 日志: 已写入 {writer.written}，缓冲 {len(writer.buffer)}，丢弃 {writer.dropped}")
+        lines.append(self.config_writer.describe())
+        digest = self.error_digest
+        pending = sum(entry[0] for entry in digest.entries.values())
+        lines.append(f"• 错误汇总: 已发送 {digest.digests_sent} 条 (含 {digest.failures_reported} 次失败)，待发送 {pending} 次")
+        return "\n".join(lines)
+
+    def describe_rewrite(self) -> str:
+        """AI 重写缓存与熔断状态"""
+        rewriter = self.deepseek_rewriter
+        state_names = {
+            CircuitBreaker.CLOSED: '正常',
+            CircuitBreaker.OPEN: '熔断中',
+            CircuitBreaker.HALF_OPEN: '试探恢复',
+        }
+        return (f"{self.rewrite_cache.describe()}\n"
+                f"• 熔断器: {state_names[rewriter.breaker.state]}\n"
+                f"• 进行中: {rewriter.in_flight}，超时 {rewriter.timeouts}，失败 {rewriter.failures}，"
+                f"跳过 {rewriter.skipped}")
+
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """统计命令"""
         user_id = update.effective_user.id
@@ -464,44 +2427,165 @@ class TelegramForwardBot:
             await update.message.reply_text("❌ 您没有权限查看统计信息")
             return
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT COUNT(*), content_type
-            FROM forward_logs 
-            WHERE DATE(timestamp) = DATE('now')
-            GROUP BY content_type
-        ''')
-        today_stats = cursor.fetchall()
-
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total,
-                SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as success
-            FROM forward_logs 
-            WHERE DATE(timestamp) = DATE('now')
-        ''')
-        success_stats = cursor.fetchone()
+        # 参数: /stats [开始日期] [结束日期]，日期格式 YYYY-MM-DD (UTC)，默认今日
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        args = context.args or []
+        try:
+            start_day = datetime.strptime(args[0], '%Y-%m-%d').strftime('%Y-%m-%d') if args else today
+            end_day = datetime.strptime(args[1], '%Y-%m-%d').strftime('%Y-%m-%d') if len(args) > 1 else start_day
+        except ValueError:
+            await update.message.reply_text("❌ 日期格式错误，请使用 /stats [开始日期] [结束日期]，例如 /stats 2024-01-01 2024-01-31")
+            return
+        if start_day > end_day:
+            start_day, end_day = end_day, start_day
 
-        conn.close()
+        type_stats, target_stats = self.query_stats(start_day, end_day)
+        dedup_stats = dict(self.query_dedup_stats(start_day, end_day))
+        period = "今日" if start_day == end_day == today else (
+            start_day if start_day == end_day else f"{start_day} ~ {end_day}")
+        period_safe = escape_markdown_v2(period)
 
         stats_text = "📈 *详细统计*\n\n"
 
-        if today_stats:
-            stats_text += "📅 *今日转发统计:*\n"
-            for count, content_type in today_stats:
+        if type_stats:
+            stats_text += f"📅 *{period_safe}转发统计:*\n"
+            for content_type, count in type_stats:
                 content_type_safe = escape_markdown_v2(content_type or '未知')
                 stats_text += f"• {content_type_safe}: {count}条\n"
 
-        if success_stats and success_stats[0] > 0:
-            success_rate = (success_stats[1] / success_stats[0]) * 100
-            stats_text += f"\n✅ *今日成功率:* {success_rate:.1f}%"
+        total = sum(t for _, t, _ in target_stats)
+        success = sum(s for _, _, s in target_stats)
+        if total > 0:
+            success_rate = escape_markdown_v2(f"{success / total * 100:.1f}%")
+            stats_text += f"\n✅ *{period_safe}成功率:* {success_rate}\n"
+
+            stats_text += "\n🎯 *各目标频道:*\n"
+            for target_id, target_total, target_success in target_stats:
+                target_safe = escape_markdown_v2(str(target_id))
+                stats_text += f"• `{target_safe}`: {target_success}/{target_total}\n"
         else:
-            stats_text += "\n📭 今日暂无转发记录"
+            stats_text += f"\n📭 {period_safe}暂无转发记录"
+
+        suppressed = sum(dedup_stats.values())
+        if suppressed:
+            detail = escape_markdown_v2(
+                f"{suppressed}条 (媒体 {dedup_stats.get('media', 0)}，文本 {dedup_stats.get('text', 0)})")
+            stats_text += f"\n🔁 *{period_safe}跳过重复:* {detail}\n"
 
         await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN_V2)
 
+    async def replay_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """死信重放: /replay 查看概况，/replay <数量|all> 按限速重新排队，/replay stop 停止"""
+        user_id = update.effective_user.id
+        if not await self.is_admin(user_id):
+            await update.message.reply_text("❌ 您没有权限执行此操作")
+            return
+
+        args = context.args or []
+        running = self.replay_task is not None and not self.replay_task.done()
+        if not args:
+            summary = await asyncio.to_thread(self.forward_queue.dead_letter_summary)
+            total = sum(count for _, _, count in summary)
+            lines = [f"📮 死信: {total} 条"]
+            for target_id, error_class, count in summary[:10]:
+                lines.append(f"• {target_id or '全部目标'} / {error_class or '未知'}: {count}")
+            if running:
+                lines.append(f"\n🔄 正在重放，已重放 {self.replayed} 条")
+            lines.append("\n用法: /replay <数量|all> 重新发送，/replay stop 停止")
+            await update.message.reply_text("\n".join(lines))
+            return
+
+        if args[0] == 'stop':
+            if not running:
+                await update.message.reply_text("ℹ️ 当前没有进行中的重放")
+                return
+            self.replay_task.cancel()
+            await update.message.reply_text(f"⏹️ 已停止重放，共重放 {self.replayed} 条")
+            return
+
+        if running:
+            await update.message.reply_text(f"⚠️ 已有重放在进行中 (已重放 {self.replayed} 条)")
+            return
+        try:
+            limit = None if args[0] == 'all' else max(1, int(args[0]))
+        except ValueError:
+            await update.message.reply_text("❌ 参数错误，请使用 /replay <数量|all> 或 /replay stop")
+            return
+
+        per_minute = max(1, int(self.config['forward_settings'].get('replay_per_minute', 30)))
+        self.replayed = 0
+        self.replay_task = asyncio.create_task(self._replay_dead_letters(limit, 60 / per_minute, user_id))
+        await update.message.reply_text(
+            f"🔄 开始重放{'全部' if limit is None else f' {limit} 条'}死信，每分钟 {per_minute} 条")
+
+    async def _replay_dead_letters(self, limit: Optional[int], interval: float, admin_id: int):
+        """按固定间隔将死信放回队列；重放期间再次失败的消息会写入新的死信，不在本轮重复处理"""
+        last_id = 0
+        while limit is None or self.replayed < limit:
+            batch = await asyncio.to_thread(self.forward_queue.dead_letters_after, last_id, 50)
+            if not batch:
+                break
+            for dead_id in batch:
+                if limit is not None and self.replayed >= limit:
+                    break
+                last_id = dead_id
+                if await self.forward_queue.requeue(dead_id):
+                    self.replayed += 1
+                    await asyncio.sleep(interval)
+
+        logger.info(f"死信重放完成，共 {self.replayed} 条")
+        try:
+            await self.send_scheduler.send_low_priority(
+                admin_id,
+                lambda: self.application.bot.send_message(chat_id=admin_id,
+                                                          text=f"✅ 死信重放完成，共 {self.replayed} 条")
+            )
+        except Exception as e:
+            logger.error(f"通知管理员失败 {admin_id}: {e}")
+
+    def query_stats(self, start_day: str, end_day: str):
+        """从汇总表查询日期范围内的统计
+
+        返回 (按类型 [(content_type, count)], 按目标 [(target_chat_id, total, success)])
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT content_type, SUM(count)
+            FROM forward_stats_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY content_type
+            ORDER BY SUM(count) DESC
+        ''', (start_day, end_day))
+        type_stats = cursor.fetchall()
+
+        cursor.execute('''
+            SELECT target_chat_id, SUM(count), SUM(CASE WHEN success = 1 THEN count ELSE 0 END)
+            FROM forward_stats_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY target_chat_id
+            ORDER BY SUM(count) DESC
+        ''', (start_day, end_day))
+        target_stats = cursor.fetchall()
+
+        conn.close()
+        return type_stats, target_stats
+
+    def query_dedup_stats(self, start_day: str, end_day: str):
+        """日期范围内被跳过的重复消息数 [(kind, count)]"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT kind, SUM(count)
+            FROM dedup_stats_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY kind
+        ''', (start_day, end_day))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """管理面板"""
         user_id = update.effective_user.id
@@ -642,7 +2726,7 @@ class TelegramForwardBot:
         if data == "toggle_source_info":
             current = self.config['forward_settings']['add_source_info']
             self.config['forward_settings']['add_source_info'] = not current
-            self.save_config()
+            self.apply_config()
             status = "开启" if not current else "关闭"
             await query.edit_message_text(text=f"✅ 来源信息显示已{status}")
 
@@ -651,7 +2735,7 @@ class TelegramForwardBot:
                 self.config['deepseek_settings'] = {}
             current = self.config['deepseek_settings'].get('enabled', False)
             self.config['deepseek_settings']['enabled'] = not current
-            self.save_config()
+            self.apply_config()
             self.deepseek_rewriter.update_config(self.config)
             status = "开启" if not current else "关闭"
             await query.edit_message_text(text=f"✅ DeepSeek AI 重写已{status}")
@@ -786,26 +2870,28 @@ API 地址: {base_url}
 
         chat_id = message.chat_id
         user_id = message.from_user.id if message.from_user else None
+        snapshot = self.snapshot
 
         # 如果用户正在等待输入（管理员操作）
-        if user_id and user_id in self.config.get("admins", []) and context.user_data.get('awaiting_input'):
+        if user_id and user_id in snapshot.admins and context.user_data.get('awaiting_input'):
             await self.handle_admin_input(update, context)
             return
 
         # 检查是否来自源频道
-        if chat_id not in self.config['source_channels']:
+        if chat_id not in snapshot.source_channels:
             return
 
         logger.info(f"收到来自源频道的消息: {chat_id}")
-        self.stats['messages_received'] += 1
+        MESSAGES_RECEIVED.inc()
 
         content_type = self.get_message_type(message)
-        if self.should_filter_message(message, content_type):
+        if self.should_filter_message(message, content_type, snapshot):
             logger.info(f"消息 {message.message_id} 被过滤")
             return
 
-        # 将消息传递给媒体组处理器
-        await self.media_group_handler.add_message(message, self.forward_messages_group)
+        # 提取精简记录后交给媒体组处理器
+        item = MediaItem.from_message(message, content_type)
+        await self.media_group_handler.add_item(item, self.forward_messages_group)
 
     async def handle_admin_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理管理员输入"""
@@ -821,7 +2907,7 @@ API 地址: {base_url}
                 new_admin_id = int(input_text)
                 if new_admin_id not in self.config['admins']:
                     self.config['admins'].append(new_admin_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加管理员: `{new_admin_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -831,7 +2917,7 @@ API 地址: {base_url}
                 admin_id = int(input_text)
                 if admin_id in self.config['admins']:
                     self.config['admins'].remove(admin_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已移除管理员: `{admin_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -841,7 +2927,7 @@ API 地址: {base_url}
                 channel_id = int(input_text)
                 if channel_id not in self.config['source_channels']:
                     self.config['source_channels'].append(channel_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加源频道: `{channel_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -851,7 +2937,7 @@ API 地址: {base_url}
                 channel_id = int(input_text)
                 if channel_id in self.config['source_channels']:
                     self.config['source_channels'].remove(channel_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已移除源频道: `{channel_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -861,7 +2947,7 @@ API 地址: {base_url}
                 channel_id = int(input_text)
                 if channel_id not in self.config['target_channels']:
                     self.config['target_channels'].append(channel_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加目标频道: `{channel_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -871,7 +2957,7 @@ API 地址: {base_url}
                 channel_id = int(input_text)
                 if channel_id in self.config['target_channels']:
                     self.config['target_channels'].remove(channel_id)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已移除目标频道: `{channel_id}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -883,7 +2969,7 @@ API 地址: {base_url}
                     await context.bot.send_message(chat_id=chat_id, text="❌ 延迟时间不能为负数")
                 else:
                     self.config['forward_settings']['delay_seconds'] = delay
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 转发延迟已设置为 {delay} 秒")
 
             elif action == 'add_paraphrase_rule':
@@ -893,7 +2979,7 @@ API 地址: {base_url}
                     value = value.strip()
                     if key and value:
                         self.config['paraphrase_rules'][key] = value
-                        self.save_config()
+                        self.apply_config()
                         await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加伪原创规则: `{key}` → `{value}`",
                                                        parse_mode=ParseMode.MARKDOWN_V2)
                     else:
@@ -905,7 +2991,7 @@ API 地址: {base_url}
                 key = input_text.strip()
                 if key in self.config['paraphrase_rules']:
                     del self.config['paraphrase_rules'][key]
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已删除伪原创规则: `{key}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -915,7 +3001,7 @@ API 地址: {base_url}
                 keyword = input_text.strip()
                 if keyword and keyword not in self.config['forward_settings']['keyword_filter']:
                     self.config['forward_settings']['keyword_filter'].append(keyword)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已添加过滤关键词: `{keyword}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -925,7 +3011,7 @@ API 地址: {base_url}
                 keyword = input_text.strip()
                 if keyword in self.config['forward_settings']['keyword_filter']:
                     self.config['forward_settings']['keyword_filter'].remove(keyword)
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ 已删除过滤关键词: `{keyword}`",
                                                    parse_mode=ParseMode.MARKDOWN_V2)
                 else:
@@ -934,34 +3020,34 @@ API 地址: {base_url}
             elif action == 'set_deepseek_api_key':
                 api_key = input_text.strip()
                 self.config['deepseek_settings']['api_key'] = api_key
-                self.save_config()
+                self.apply_config()
                 self.deepseek_rewriter.update_config(self.config)
                 await context.bot.send_message(chat_id=chat_id, text="✅ DeepSeek API Key 已设置")
 
             elif action == 'set_deepseek_baseurl':
                 base_url = input_text.strip()
                 self.config['deepseek_settings']['base_url'] = base_url
-                self.save_config()
+                self.apply_config()
                 self.deepseek_rewriter.update_config(self.config)
                 await context.bot.send_message(chat_id=chat_id, text=f"✅ DeepSeek API 地址已设置为: {base_url}")
 
             elif action == 'set_deepseek_prompt':
                 prompt = input_text.strip()
                 self.config['deepseek_settings']['system_prompt'] = prompt
-                self.save_config()
+                self.apply_config()
                 await context.bot.send_message(chat_id=chat_id, text="✅ DeepSeek 系统提示词已设置")
 
             elif action == 'set_deepseek_model':
                 model = input_text.strip()
                 self.config['deepseek_settings']['model'] = model
-                self.save_config()
+                self.apply_config()
                 await context.bot.send_message(chat_id=chat_id, text=f"✅ DeepSeek 模型已设置为: {model}")
 
             elif action == 'set_deepseek_temperature':
                 temperature = float(input_text.strip())
                 if 0.0 <= temperature <= 2.0:
                     self.config['deepseek_settings']['temperature'] = temperature
-                    self.save_config()
+                    self.apply_config()
                     await context.bot.send_message(chat_id=chat_id, text=f"✅ DeepSeek 温度已设置为: {temperature}")
                 else:
                     await context.bot.send_message(chat_id=chat_id, text="❌ 温度值必须在 0.0 到 2.0 之间")
@@ -973,7 +3059,7 @@ API 地址: {base_url}
                     self.config['deepseek_settings']['enabled'] = True
                     self.deepseek_rewriter.update_config(self.config)
 
-                    rewritten = await self.deepseek_rewriter.rewrite_text(input_text)
+                    rewritten = await self.deepseek_rewriter.rewrite_text(input_text, force=True)
 
                     self.config['deepseek_settings']['enabled'] = original_enabled
                     self.deepseek_rewriter.update_config(self.config)
@@ -1022,201 +3108,329 @@ API 地址: {base_url}
         else:
             return "other"
 
-    def should_filter_message(self, message: Message, content_type: str) -> bool:
+    def should_filter_message(self, message: Message, content_type: str,
+                              snapshot: Optional[ConfigSnapshot] = None) -> bool:
         """检查消息是否应被过滤"""
-        # 内容类型过滤
-        if content_type in self.config['forward_settings']['filter_content_types']:
-            return True
-
-        # 关键词过滤
-        message_content = message.text or message.caption or ""
-        if message_content and self.config['forward_settings']['keyword_filter']:
-            text_lower = message_content.lower()
-            for keyword in self.config['forward_settings']['keyword_filter']:
-                if keyword.lower() in text_lower:
-                    logger.info(f"消息被关键词过滤: {keyword}")
-                    return True
-
-        return False
+        snapshot = snapshot or self.snapshot
+        started = time.perf_counter()
+        try:
+            # 内容类型过滤
+            if content_type in snapshot.filter_content_types:
+                return True
+
+            # 关键词过滤
+            message_content = message.text or message.caption or ""
+            keyword = snapshot.keyword_matcher.search(message_content)
+            if keyword is not None:
+                logger.info(f"消息被关键词过滤: {keyword}")
+                return True
+
+            return False
+        finally:
+            # 每次过滤判断都计入，包括按内容类型直接过滤的消息
+            KEYWORD_MATCH_SECONDS.observe(time.perf_counter() - started)
 
     def apply_paraphrase_rules(self, text: str) -> str:
         """应用伪原创替换规则"""
-        rules = self.config.get('paraphrase_rules', {})
-        if not rules or not text:
-            return text
-
-        modified_text = text
-        for old_word, new_word in rules.items():
-            modified_text = modified_text.replace(old_word, new_word)
-        return modified_text
+        return self.snapshot.paraphrase_engine.apply(text)
 
-    async def build_caption(self, message: Message) -> str:
+    async def build_caption(self, item: MediaItem) -> str:
         """构建转发消息的说明"""
-        original_text = message.caption or message.text or ""
+        snapshot = self.snapshot
+        original_text = item.text or ""
 
         # 1. 应用伪原创替换规则
-        processed_text = self.apply_paraphrase_rules(original_text)
+        processed_text = snapshot.paraphrase_engine.apply(original_text)
 
         # 2. 使用 DeepSeek AI 重写（如果启用）
-        if self.config.get('deepseek_settings', {}).get('enabled', False):
+        if snapshot.deepseek_enabled:
             processed_text = await self.deepseek_rewriter.rewrite_text(processed_text)
 
         # 3. 添加来源信息（如果启用）
-        if self.config['forward_settings']['add_source_info']:
-            chat_title = message.chat.title or str(message.chat.id)
-            time_str = message.date.strftime('%Y-%m-%d %H:%M:%S')
+        if snapshot.add_source_info:
+            chat_title = item.chat_title or str(item.chat_id)
+            time_str = datetime.fromtimestamp(item.date, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
             source_info = f"\n\n📢 来源: {chat_title}\n⏰ 时间: {time_str}"
 
-            if message.from_user and self.config['forward_settings']['preserve_sender']:
-                sender_name = message.from_user.full_name
-                source_info += f"\n👤 发送者: {sender_name}"
+            if item.sender_name and snapshot.preserve_sender:
+                source_info += f"\n👤 发送者: {item.sender_name}"
 
             processed_text += source_info
 
         return processed_text
 
-    async def forward_messages_group(self, messages: List[Message]):
-        """转发消息组"""
-        if not messages:
+    def needs_processing(self) -> bool:
+        """是否需要对消息文案进行处理"""
+        return self.snapshot.needs_processing
+
+    async def prepare_caption(self, item: MediaItem) -> str:
+        """每条消息只处理一次文案，结果由所有目标频道共用"""
+        key = (item.chat_id, item.message_id)
+        task = self._caption_cache.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.build_caption(item))
+            self._caption_cache[key] = task
+            while len(self._caption_cache) > self._caption_cache_size:
+                self._caption_cache.popitem(last=False)
+        else:
+            self._caption_cache.move_to_end(key)
+
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 处理失败时不缓存异常，下次重新处理
+            if self._caption_cache.get(key) is task:
+                del self._caption_cache[key]
+            raise
+
+    async def forward_messages_group(self, items: List[MediaItem]):
+        """将消息组写入转发队列，由后台协程处理"""
+        if not items:
             return
 
-        targets = self.config['target_channels']
-        if not targets:
+        snapshot = self.snapshot
+        if not snapshot.target_channels:
             return
 
-        # 转发延迟
-        delay = self.config['forward_settings']['delay_seconds']
-        if delay > 0:
-            await asyncio.sleep(delay)
+        # 同一内容已从其他源频道转发过时跳过，避免重复发送和重复 AI 重写
+        if snapshot.dedup_enabled:
+            kind = await self.duplicate_filter.is_duplicate(items)
+            if kind:
+                logger.info(f"跳过重复消息 ({kind}): {items[0].chat_id}/{items[0].message_id}")
+                return
+
+        # 转发延迟由队列的可处理时间实现，不阻塞消息处理
+        delay = snapshot.delay_seconds
+        await self.forward_queue.put({'items': [item.to_dict() for item in items]}, delay)
+
+    async def _queue_worker(self, worker_id: int):
+        """转发队列处理协程"""
+        while True:
+            job = await self.forward_queue.claim()
+            if job is None:
+                await self.forward_queue.wait_for_job()
+                continue
+
+            job_id, payload, attempts = job
+            try:
+                await self.execute_forward(self.load_job_items(payload), payload.get('targets'),
+                                           payload.get('retry', 0))
+                await self.forward_queue.done(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"转发任务 {job_id} 处理失败 (worker {worker_id}, 第{attempts}次): {e}")
+                await self.forward_queue.fail(job_id, attempts, e)
+
+    def load_job_items(self, payload: dict) -> List[MediaItem]:
+        """解析队列任务中的消息记录"""
+        if 'items' in payload:
+            return [MediaItem.from_dict(data) for data in payload['items']]
+        # 兼容旧版本写入的完整消息
+        items = []
+        for data in payload.get('messages', []):
+            message = Message.de_json(data, self.application.bot)
+            items.append(MediaItem.from_message(message, self.get_message_type(message)))
+        return items
+
+    async def execute_forward(self, items: List[MediaItem], targets: Optional[List[int]] = None,
+                              retry: int = 0):
+        """执行转发，targets 为空时发往所有目标频道"""
+        if not items:
+            return
 
-        is_media_group = len(messages) > 1 and messages[0].media_group_id
+        is_media_group = len(items) > 1 and items[0].media_group_id
 
         if is_media_group:
-            await self.forward_media_group(messages)
+            await self.forward_media_group(items, targets, retry)
         else:
-            await self.forward_single_message(messages[0])
+            await self.forward_single_message(items[0], targets, retry)
+
+    def job_targets(self, targets: Optional[List[int]]) -> tuple:
+        """任务的目标频道: 重试与重放的任务只发往仍在配置中的目标"""
+        snapshot = self.snapshot
+        if targets is None:
+            return snapshot.target_channels
+        return tuple(target_id for target_id in targets if target_id in snapshot.target_set)
+
+    async def schedule_retry(self, items: List[MediaItem], target_id: int, error: Exception,
+                             retry: int) -> bool:
+        """临时错误按指数退避只为该目标重新排队；永久错误或重试用尽时写入死信表并返回 False"""
+        settings = self.config['forward_settings']
+        payload = {'items': [item.to_dict() for item in items], 'targets': [target_id]}
+        retryable = is_retryable_error(error)
+        try:
+            if retryable and retry < int(settings.get('retry_max_attempts', 5)):
+                delay = backoff_delay(retry, settings.get('retry_base_seconds', 5),
+                                      settings.get('retry_max_seconds', 600), error)
+                payload['retry'] = retry + 1
+                await self.forward_queue.put(payload, delay)
+                FORWARD_RETRIES.inc(1, (type(error).__name__,))
+                logger.warning(f"发送失败 -> {target_id}: {error}，{delay:.0f}秒后第{retry + 1}次重试")
+                return True
+            await self.forward_queue.bury(payload, target_id, error, retry + 1)
+            DEAD_LETTERS.inc(1, ('exhausted' if retryable else 'permanent',))
+            # 还没有任何目标发送成功时释放去重预留
+            self.duplicate_filter.release(items)
+        except Exception as e:
+            logger.error(f"登记重试失败 -> {target_id}: {e}")
+        return False
 
-    async def forward_media_group(self, messages: List[Message]):
-        """转发媒体组"""
-        targets = self.config['target_channels']
+    async def _fan_out(self, targets: List[int], send_to_target):
+        """向所有目标频道分发，并发模式下总耗时取决于最慢的目标"""
+        if len(targets) > 1 and self.snapshot.concurrent_forward:
+            await asyncio.gather(*(send_to_target(target_id) for target_id in targets), return_exceptions=True)
+        else:
+            for target_id in targets:
+                await send_to_target(target_id)
 
-        for target_id in targets:
-            try:
-                media_list = []
-                caption_text = await self.build_caption(messages[0])
+    async def forward_media_group(self, items: List[MediaItem], targets: Optional[List[int]] = None,
+                                  retry: int = 0):
+        """转发媒体组"""
+        targets = self.job_targets(targets)
+        if not targets:
+            return
 
-                for i, message in enumerate(messages):
-                    if i == 0:
-                        input_media = self.create_input_media(message, caption_text)
-                    else:
-                        input_media = self.create_input_media(message)
+        # 文案与媒体列表只构建一次，所有目标共用
+        caption_text = await self.prepare_caption(items[0])
+        media_list = []
+        for i, item in enumerate(items):
+            if i == 0:
+                input_media = self.create_input_media(item, caption_text)
+            else:
+                input_media = self.create_input_media(item)
 
-                    if input_media:
-                        media_list.append(input_media)
+            if input_media:
+                media_list.append(input_media)
 
+        async def send_to_target(target_id: int):
+            started = time.monotonic()
+            try:
                 if media_list:
-                    await self.application.bot.send_media_group(
-                        chat_id=target_id,
-                        media=media_list
+                    await self.send_scheduler.send(
+                        target_id,
+                        lambda: self.application.bot.send_media_group(chat_id=target_id, media=media_list),
+                        cost=len(media_list)
                     )
 
-                    self.stats['messages_forwarded'] += len(messages)
-                    self.stats['media_groups_forwarded'] += 1
-                    logger.info(f"媒体组已转发: -> {target_id} ({len(messages)}条)")
+                    FORWARD_SECONDS.observe(time.monotonic() - started, ('media_group', 'ok'))
+                    MESSAGES_FORWARDED.inc(len(items), ('media_group',))
+                    MEDIA_GROUPS_FORWARDED.inc()
+                    logger.info(f"媒体组已转发: -> {target_id} ({len(items)}条)")
+                    await self.duplicate_filter.confirm(items)
 
                     # 记录日志
-                    for msg in messages:
-                        self.log_forward(msg.chat_id, target_id, msg.message_id, None,
-                                         self.get_message_type(msg), msg.media_group_id, True, True, None)
+                    for item in items:
+                        self.log_forward(item.chat_id, target_id, item.message_id, None,
+                                         item.media_type, item.media_group_id, True, True, None)
 
             except Exception as e:
+                FORWARD_SECONDS.observe(time.monotonic() - started, ('media_group', 'error'))
+                if await self.schedule_retry(items, target_id, e, retry):
+                    return
                 error_msg = str(e)
                 logger.error(f"媒体组转发失败 -> {target_id}: {error_msg}")
-                self.stats['failed_forwards'] += len(messages)
+                FORWARD_FAILURES.inc(len(items), (type(e).__name__,))
+
+                for item in items:
+                    self.log_forward(item.chat_id, target_id, item.message_id, None,
+                                     item.media_type, item.media_group_id, True, False, error_msg)
 
-                for msg in messages:
-                    self.log_forward(msg.chat_id, target_id, msg.message_id, None,
-                                     self.get_message_type(msg), msg.media_group_id, True, False, error_msg)
+                if self.snapshot.notify_admin_on_error:
+                    self.notify_admins_error(items[0], target_id, e)
 
-                if self.config['notification_settings']['notify_admin_on_error']:
-                    await self.notify_admins_error(messages[0], target_id, error_msg)
+        await self._fan_out(targets, send_to_target)
 
-    async def forward_single_message(self, message: Message):
+    async def forward_single_message(self, item: MediaItem, targets: Optional[List[int]] = None,
+                                     retry: int = 0):
         """转发单条消息"""
-        targets = self.config['target_channels']
-        content_type = self.get_message_type(message)
+        targets = self.job_targets(targets)
+        if not targets:
+            return
+        content_type = item.media_type
 
-        for target_id in targets:
-            try:
-                need_process = (
-                        self.config.get('deepseek_settings', {}).get('enabled', False) or
-                        bool(self.config.get('paraphrase_rules', {})) or
-                        self.config['forward_settings']['add_source_info']
-                )
+        # 文案只处理一次，所有目标共用
+        need_process = self.needs_processing()
+        caption = await self.prepare_caption(item) if need_process else None
 
+        async def send_to_target(target_id: int):
+            started = time.monotonic()
+            try:
                 if need_process:
-                    caption = await self.build_caption(message)
-
-                    if content_type == "text":
-                        await self.application.bot.send_message(chat_id=target_id, text=caption)
-                    elif content_type == "photo":
-                        photo = message.photo[-1]
-                        await self.application.bot.send_photo(chat_id=target_id, photo=photo.file_id, caption=caption)
-                    elif content_type == "video":
-                        await self.application.bot.send_video(chat_id=target_id, video=message.video.file_id,
-                                                              caption=caption)
-                    elif content_type == "document":
-                        await self.application.bot.send_document(chat_id=target_id, document=message.document.file_id,
-                                                                 caption=caption)
-                    elif content_type == "audio":
-                        await self.application.bot.send_audio(chat_id=target_id, audio=message.audio.file_id,
-                                                              caption=caption)
-                    elif content_type == "voice":
-                        await self.application.bot.send_voice(chat_id=target_id, voice=message.voice.file_id,
-                                                              caption=caption)
-                    elif content_type == "animation":
-                        await self.application.bot.send_animation(chat_id=target_id,
-                                                                  animation=message.animation.file_id, caption=caption)
-                    else:
-                        await self.application.bot.copy_message(
+                    await self.send_scheduler.send(
+                        target_id,
+                        lambda: self.send_processed_message(item, target_id, caption)
+                    )
+                else:
+                    await self.send_scheduler.send(
+                        target_id,
+                        lambda: self.application.bot.copy_message(
                             chat_id=target_id,
-                            from_chat_id=message.chat_id,
-                            message_id=message.message_id
+                            from_chat_id=item.chat_id,
+                            message_id=item.message_id
                         )
-                else:
-                    await self.application.bot.copy_message(
-                        chat_id=target_id,
-                        from_chat_id=message.chat_id,
-                        message_id=message.message_id
                     )
 
-                self.stats['messages_forwarded'] += 1
+                FORWARD_SECONDS.observe(time.monotonic() - started, ('single', 'ok'))
+                MESSAGES_FORWARDED.inc(1, ('single',))
                 logger.info(f"消息已转发: -> {target_id}")
-                self.log_forward(message.chat_id, target_id, message.message_id, None,
+                await self.duplicate_filter.confirm([item])
+                self.log_forward(item.chat_id, target_id, item.message_id, None,
                                  content_type, None, False, True, None)
 
             except Exception as e:
+                FORWARD_SECONDS.observe(time.monotonic() - started, ('single', 'error'))
+                if await self.schedule_retry([item], target_id, e, retry):
+                    return
                 error_msg = str(e)
                 logger.error(f"转发失败 -> {target_id}: {error_msg}")
-                self.stats['failed_forwards'] += 1
-                self.log_forward(message.chat_id, target_id, message.message_id, None,
+                FORWARD_FAILURES.inc(1, (type(e).__name__,))
+                self.log_forward(item.chat_id, target_id, item.message_id, None,
                                  content_type, None, False, False, error_msg)
 
-                if self.config['notification_settings']['notify_admin_on_error']:
-                    await self.notify_admins_error(message, target_id, error_msg)
+                if self.snapshot.notify_admin_on_error:
+                    self.notify_admins_error(item, target_id, e)
+
+        await self._fan_out(targets, send_to_target)
+
+    async def send_processed_message(self, item: MediaItem, target_id: int, caption: str):
+        """按消息类型发送处理后的内容"""
+        bot = self.application.bot
+        content_type = item.media_type
+        if content_type == "text":
+            await bot.send_message(chat_id=target_id, text=caption)
+        elif content_type == "photo":
+            await bot.send_photo(chat_id=target_id, photo=item.file_id, caption=caption)
+        elif content_type == "video":
+            await bot.send_video(chat_id=target_id, video=item.file_id, caption=caption)
+        elif content_type == "document":
+            await bot.send_document(chat_id=target_id, document=item.file_id, caption=caption)
+        elif content_type == "audio":
+            await bot.send_audio(chat_id=target_id, audio=item.file_id, caption=caption)
+        elif content_type == "voice":
+            await bot.send_voice(chat_id=target_id, voice=item.file_id, caption=caption)
+        elif content_type == "animation":
+            await bot.send_animation(chat_id=target_id, animation=item.file_id, caption=caption)
+        else:
+            await bot.copy_message(
+                chat_id=target_id,
+                from_chat_id=item.chat_id,
+                message_id=item.message_id
+            )
 
-    def create_input_media(self, message: Message, caption: str = None):
+    def create_input_media(self, item: MediaItem, caption: str = None):
         """创建 InputMedia 对象"""
         try:
-            if message.photo:
-                photo = message.photo[-1]
-                return InputMediaPhoto(media=photo.file_id, caption=caption)
-            elif message.video:
-                return InputMediaVideo(media=message.video.file_id, caption=caption)
-            elif message.document:
-                return InputMediaDocument(media=message.document.file_id, caption=caption)
-            elif message.audio:
-                return InputMediaAudio(media=message.audio.file_id, caption=caption)
+            if item.media_type == "photo":
+                return InputMediaPhoto(media=item.file_id, caption=caption)
+            elif item.media_type == "video":
+                return InputMediaVideo(media=item.file_id, caption=caption)
+            elif item.media_type == "document":
+                return InputMediaDocument(media=item.file_id, caption=caption)
+            elif item.media_type == "audio":
+                return InputMediaAudio(media=item.file_id, caption=caption)
             else:
                 return None
         except Exception as e:
@@ -1227,48 +3441,104 @@ API 地址: {base_url}
                     original_msg_id: int, forwarded_msg_id: int,
                     content_type: str, media_group_id: str, is_media_group: bool,
                     success: bool, error_msg: str):
-        """记录转发日志"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        """记录转发日志 (写入缓冲区，由 ForwardLogWriter 批量落库)"""
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.log_writer.add((source_chat_id, target_chat_id, original_msg_id,
+                             forwarded_msg_id, content_type, media_group_id, is_media_group,
+                             success, error_msg, timestamp))
+
+    def notify_admins_error(self, item: MediaItem, target_id: int, error: Exception):
+        """登记转发错误，汇总后统一通知管理员"""
+        chat_title = item.chat_title or str(item.chat_id)
+        self.error_digest.add(target_id, type(error).__name__, chat_title, str(error))
+        if self.error_digest.task is None or self.error_digest.task.done():
+            self.error_digest.task = asyncio.create_task(self._send_error_digest())
+
+    async def _send_error_digest(self):
+        """等待汇总窗口结束后，经低优先级通道给每位管理员发送一条汇总
+
+        发送期间登记的新失败由同一个任务在下一个窗口发出，直到没有待汇总的失败才退出。
+        """
+        while True:
+            await asyncio.sleep(self.error_digest.delay())
+            text = self.error_digest.take()
+            if not text:
+                return
+            for admin_id in self.snapshot.admins:
+                try:
+                    await self.send_scheduler.send_low_priority(
+                        admin_id,
+                        lambda admin_id=admin_id: self.application.bot.send_message(chat_id=admin_id, text=text)
+                    )
+                except Exception as e:
+                    logger.error(f"通知管理员失败 {admin_id}: {e}")
 
-            cursor.execute('''
-                INSERT INTO forward_logs 
-                (source_chat_id, target_chat_id, original_message_id, 
-                 forwarded_message_id, content_type, media_group_id, is_media_group, success, error_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (source_chat_id, target_chat_id, original_msg_id,
-                  forwarded_msg_id, content_type, media_group_id, is_media_group, success, error_msg))
-
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"记录转发日志失败: {e}")
+    async def post_init(self, application: Application):
+        """启动后恢复未完成的任务并启动队列处理协程"""
+        recovered = await asyncio.to_thread(self.forward_queue.recover)
+        if recovered:
+            logger.info(f"已恢复 {recovered} 个未完成的转发任务")
 
-    async def notify_admins_error(self, message: Message, target_id: int, error_msg: str):
-        """通知管理员转发错误"""
-        chat_title = message.chat.title or str(message.chat.id)
-        time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        workers = max(1, int(self.config['forward_settings'].get('queue_workers', 4)))
+        self.queue_workers = [asyncio.create_task(self._queue_worker(i)) for i in range(workers)]
+        logger.info(f"✅ 已启动 {workers} 个转发队列处理协程")
 
-        error_text = f"""❌ 转发失败通知
+        self.log_writer.start()
 
-📢 源频道: {chat_title}
-🎯 目标频道: {target_id}
-⚠️ 错误信息: {error_msg}
-⏰ 时间: {time_str}"""
+        loaded = await asyncio.to_thread(self.duplicate_filter.load)
+        if loaded:
+            logger.info(f"已恢复 {loaded} 条去重指纹")
 
-        for admin_id in self.config['admins']:
+        metrics = self.config.get('metrics', {})
+        if metrics.get('enabled'):
+            listen, port = metrics.get('listen', '127.0.0.1'), int(metrics.get('port', 9108))
             try:
-                await self.application.bot.send_message(chat_id=admin_id, text=error_text)
-            except Exception as e:
-                logger.error(f"通知管理员失败 {admin_id}: {e}")
+                self.metrics_server = await METRICS.serve(listen, port)
+                logger.info(f"✅ 指标导出: http://{listen}:{port}/metrics")
+            except OSError as e:
+                logger.error(f"启动指标导出失败 ({listen}:{port}): {e}")
+
+    async def post_shutdown(self, application: Application):
+        """停止队列处理协程，未完成的任务在下次启动时恢复"""
+        if self.replay_task:
+            self.replay_task.cancel()
+            await asyncio.gather(self.replay_task, return_exceptions=True)
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        if self.error_digest.task:
+            self.error_digest.task.cancel()
+            await asyncio.gather(self.error_digest.task, return_exceptions=True)
+        if self.error_digest.entries:
+            logger.warning(f"退出时仍有 {len(self.error_digest.entries)} 类转发错误未通知管理员")
+        for task in self.queue_workers:
+            task.cancel()
+        await asyncio.gather(*self.queue_workers, return_exceptions=True)
+        self.queue_workers = []
+        # 未完成的媒体组写入队列，下次启动时继续处理
+        await self.media_group_handler.close()
+        self.forward_queue.close()
+        self.rewrite_cache.close()
+        self.duplicate_filter.close()
+        await self.log_writer.close()
+        await self.config_writer.close()
+        if self.log_writer.dropped:
+            logger.warning(f"转发日志共丢弃 {self.log_writer.dropped} 条")
 
     def run(self):
         """运行机器人"""
         print(BANNER)
         logger.info("机器人启动中...")
         self.media_group_handler.timeout_seconds = self.config['forward_settings']['media_group_timeout']
-        self.application.run_polling()
+        self.media_group_handler.min_wait_seconds = self.config['forward_settings']['media_group_min_wait']
+        if self.config['webhook'].get('enabled'):
+            options = self.webhook_options()
+            if not options['webhook_url']:
+                logger.warning("未设置 webhook_url，Telegram 只接受 HTTPS 地址，请在反向代理后配置公网地址")
+            logger.info(f"Webhook 模式: 监听 {options['listen']}:{options['port']}/{options['url_path']}")
+            self.application.run_webhook(**options)
+        else:
+            self.application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
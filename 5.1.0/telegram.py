@@ -7,11 +7,14 @@ from telethon.events import NewMessage
 import asyncio
 import json
 import os
+import shutil
 import sys
+import tempfile
 import random
 import re
 from datetime import datetime, timedelta
 from collections import defaultdict
+from typing import Optional
 from openai import AsyncOpenAI
 
 # 用于处理媒体组的缓存和锁
@@ -31,6 +34,104 @@ BANNER = f"""
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, 'config.json')
 
+class ConfigWriter:
+    """配置文件写入器 (合并多次保存、原子替换、保留备份)"""
+
+    def __init__(self, path: str, debounce_seconds: float = 1.0, backups: int = 3, indent: int = 2):
+        self.path = path
+        self.debounce_seconds = debounce_seconds
+        self.backups = backups
+        self.indent = indent
+        self.pending: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    def save(self, config: dict):
+        """登记一次修改，稍后写入"""
+        self.pending = config
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.debounce_seconds)
+        await self.flush()
+
+    async def flush(self):
+        """立即写入尚未保存的修改"""
+        async with self.lock:
+            while self.pending is not None:
+                # 序列化在事件循环中完成，避免与配置修改并发
+                data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+                self.pending = None
+                await asyncio.to_thread(self._write, data)
+
+    async def close(self):
+        """取消等待中的延迟写入，立即写入剩余修改"""
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush()
+
+    def flush_sync(self):
+        """同步写入，用于启动阶段"""
+        if self.pending is not None:
+            data = json.dumps(self.pending, ensure_ascii=False, indent=self.indent)
+            self.pending = None
+            self._write(data)
+
+    def _write(self, data: str):
+        try:
+            self._rotate_backups()
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._fsync_directory(directory)
+        except Exception as e:
+            print(f"❌ 保存配置文件失败: {e}")
+
+    def _rotate_backups(self):
+        """config.json.1 为最近一次的备份，编号越大越旧"""
+        if self.backups <= 0 or not os.path.exists(self.path):
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        shutil.copy2(self.path, f"{self.path}.1")
+
+    @staticmethod
+    def _fsync_directory(directory: str):
+        """确保替换操作落盘 (Windows 不支持打开目录，忽略)"""
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def describe(self) -> str:
+        """写入次数与耗时"""
+        return f"• 配置写入: {self.writes} 次，最近 {self.last_ms:.1f}ms，最长 {self.max_ms:.1f}ms"
+
+
 
 def load_config():
     """加载配置文件"""
@@ -71,10 +172,12 @@ def load_config():
         return json.load(f)
 
 
+config_writer = ConfigWriter(CONFIG_FILE, indent=4)
+
+
 def save_config(cfg):
-    """保存配置文件"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=4)
+    """保存配置文件 (合并短时间内的多次修改，后台写入)"""
+    config_writer.save(cfg)
 
 
 # 加载配置
@@ -845,6 +948,9 @@ async def main():
 • 回复概率: {ai_prob}%
 • 冷却时间: {ai_cooldown}秒
 • API配置: {'✅' if ai_manager.client else '❌'}
+
+💾 *存储:*
+{config_writer.describe()}
 """
             await event.reply(status_text, parse_mode='Markdown')
 
@@ -948,7 +1054,11 @@ async def main():
 
     # 保持运行
     print("🚀 开始监听消息...")
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        # 退出前写入尚未保存的配置
+        await config_writer.close()
 
 
 if __name__ == '__main__':